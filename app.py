@@ -0,0 +1,330 @@
+import streamlit as st
+import threading
+import asyncio
+import uuid
+import time
+
+# Only the light modules here: chatbot (llama-index, FAISS, Gemini) is imported by the
+# background loader and streamlit_pdf_viewer when the first PDF is shown
+from metrics import Metrics, JsonlMetricsSink
+from stores import PdfStore, ConversationStore, data_version, index_version, PERSIST_DIRS
+
+# Every query and ingest run is appended here as one JSON line
+METRICS_LOG = 'storage/metrics.jsonl'
+# Set to a port (e.g. 9464) to serve the metrics in Prometheus format at /metrics
+METRICS_PORT = None
+# Chat history of every user, kept across restarts
+CONVERSATION_DB = 'storage/conversations.sqlite'
+# False: start from the index built by ingest.py and switch to a new one as soon as it is
+# persisted. True: also read data/ on start and embed whatever changed (slower start).
+# Without a prebuilt index the app builds one either way.
+INGEST_ON_START = False
+# How often a page waiting for the chatbot to load checks again
+LOADING_POLL_SECONDS = 1.0
+
+
+@st.cache_resource
+def get_build_lock():
+    return threading.Lock()
+
+
+@st.cache_resource
+def get_pdf_store(pdf_dir):
+    return PdfStore(pdf_dir)
+
+
+@st.cache_resource
+def get_conversation_store():
+    return ConversationStore(CONVERSATION_DB)
+
+
+@st.cache_resource
+def get_metrics():
+    # Outlives Chatbot rebuilds, so the totals and the scrape endpoint survive a data change
+    metrics = Metrics(sinks=[JsonlMetricsSink(METRICS_LOG)])
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+    return metrics
+
+
+class ChatbotLoader:
+    # Builds the Chatbot on a background thread so the page renders (history, sidebar) while
+    # llama-index is imported and the index is loaded. A new data or index version is loaded the
+    # same way, and the previous Chatbot keeps answering until it is ready.
+    def __init__(self, data_dir, vector_backend, metrics, build_lock):
+        self.data_dir = data_dir
+        self.vector_backend = vector_backend
+        self.metrics = metrics
+        self.build_lock = build_lock
+        self.lock = threading.Lock()
+        self.chatbot = None
+        self.version = None
+        # Its own flag: the version is None while nothing is persisted yet
+        self.loading = False
+        self.started = None
+        self.error = None
+
+    def request(self, version):
+        with self.lock:
+            if self.loading or (self.chatbot is not None and version == self.version):
+                return
+            self.loading = True
+            self.started = time.perf_counter()
+            self.error = None
+        threading.Thread(target=self.load, args=(version,), daemon=True).start()
+
+    def load(self, version):
+        try:
+            from chatbot import Chatbot
+            with self.build_lock:
+                chatbot = Chatbot(data_dir=self.data_dir, persist_dir=PERSIST_DIRS[self.vector_backend],
+                                  vector_backend=self.vector_backend, ingest=INGEST_ON_START, metrics=self.metrics)
+            if version is None and not INGEST_ON_START:
+                # Nothing was persisted, so the Chatbot just built and persisted the index itself
+                version = index_version(PERSIST_DIRS[self.vector_backend])
+            with self.lock:
+                self.chatbot, self.version, self.error = chatbot, version, None
+            print(f'Chatbot ready in {time.perf_counter() - self.started:.1f}s')
+        except Exception as e:
+            # Shown on the page; the next rerun tries again
+            print('Could not load the chatbot:', e)
+            with self.lock:
+                self.error = e
+        finally:
+            with self.lock:
+                self.loading = False
+
+
+@st.cache_resource
+def get_chatbot_loader(data_dir, vector_backend):
+    # One Chatbot per process, shared by every session
+    return ChatbotLoader(data_dir, vector_backend, get_metrics(), get_build_lock())
+
+
+#################################################################################
+
+
+def run(vector_backend='faiss'):
+    # The Streamlit page; main_faiss.py and main_no_faiss.py only pick the vector store backend
+    st.set_page_config(page_title="ChatBot Của Tôi", page_icon="💬")
+
+    # Custom CSS for dynamic message styling
+    st.markdown("""
+    <style>
+    .user-message {
+        background-color: #f0f2f6;
+        border-radius: 10px;
+        padding: 10px;
+        margin-bottom: 10px;
+        display: inline-block;
+        max-width: 80%;
+        margin-left: auto;
+        color: #003366; 
+    }
+    .bot-message {
+        background-color: #e6f2ff;
+        border-radius: 10px;
+        padding: 10px;
+        margin-bottom: 10px;
+        display: inline-block;
+        max-width: 80%;
+        color: #003366; 
+    }
+    </style>
+    """, unsafe_allow_html=True)
+
+    # Khởi tạo trạng thái Session State nếu chưa tồn tại
+    if "user_id" not in st.session_state:
+        # Định danh người dùng nằm trên URL (?user=...), nên tải lại trang hay khởi động lại server vẫn giữ lịch sử
+        st.session_state.user_id = st.query_params.get("user") or uuid.uuid4().hex
+        st.query_params["user"] = st.session_state.user_id
+    if "menu_states" not in st.session_state:
+        st.session_state.menu_states = {}  # Lưu trạng thái của menu tùy chọn
+
+    # Mô hình dùng chung cho mọi phiên, mỗi phiên chỉ giữ hội thoại của riêng mình.
+    # Mô hình được tải ở luồng nền, trang vẫn hiển thị lịch sử trong lúc chờ.
+    version = data_version('data') if INGEST_ON_START else index_version(PERSIST_DIRS[vector_backend])
+    loader = get_chatbot_loader('data', vector_backend)
+    loader.request(version)
+    llm_model = loader.chatbot
+    pdf_store = get_pdf_store('data_PDF')
+    # Hội thoại lưu trên đĩa, phiên chỉ giữ id hội thoại đang chọn và số tin nhắn đang hiển thị
+    conversation_store = get_conversation_store()
+    # Chỉ hiển thị các trang ghi trong Origin thay vì toàn bộ PDF
+    SHOW_ORIGIN_PAGES_ONLY = False
+    # Số tin nhắn hiển thị mỗi lần, tin cũ hơn chỉ tải khi bấm "Xem tin nhắn cũ hơn"
+    MESSAGE_PAGE_SIZE = 20
+
+    conversations = dict(conversation_store.conversations(st.session_state.user_id))  # {id: tên}
+    if not conversations:
+        conversations = {conversation_store.create(st.session_state.user_id, "Chat 1"): "Chat 1"}
+    if st.session_state.get("selected_conversation") not in conversations:
+        st.session_state.selected_conversation = next(iter(conversations))
+        st.session_state.visible_messages = MESSAGE_PAGE_SIZE
+
+    # Hàm hiển thị PDF
+    def display_pdf(book_id, pages=()):
+        try:
+            # Lấy PDF từ bộ nhớ đệm, chỉ đọc đĩa khi chưa có
+            pdf_data = pdf_store.get(book_id)
+            if pdf_data is None:
+                st.error(f"Không tìm thấy file PDF cho ID: {book_id}")
+                return
+
+            # Hiển thị PDF (cho phép cuộn), chỉ các trang trong pages nếu có
+            from streamlit_pdf_viewer import pdf_viewer
+            pdf_viewer(input=pdf_data, width=800, height=600, pages_to_render=pages)
+            # Lịch sử chỉ ghi tên tài liệu, không lưu cả file PDF
+            conversation_store.append(selected_chat, "assistant", f"📄 PDF: {book_id}")
+        except Exception as e:
+            st.error(f"Có lỗi xảy ra khi hiển thị PDF: {str(e)}")
+
+    def select_chat(chat_id):
+        st.session_state.selected_conversation = chat_id
+        st.session_state.visible_messages = MESSAGE_PAGE_SIZE
+
+    def create_new_chat():
+        new_name = f"Chat {len(conversations) + 1}"
+        chat_id = conversation_store.create(st.session_state.user_id, new_name)
+        conversations[chat_id] = new_name
+        select_chat(chat_id)
+
+    def create_chat_button(chat_id):
+        col1, col2 = st.columns([6, 1])
+        with col1:
+            if st.button(conversations[chat_id], key=f"chat_select_{chat_id}"):
+                select_chat(chat_id)
+        with col2:
+            if st.button("⋮", key=f"menu_{chat_id}"):
+                st.session_state.menu_states[chat_id] = not st.session_state.menu_states.get(chat_id, False)
+
+    # Sidebar    
+    with st.sidebar:
+        st.markdown("<h2 style='text-align: center;'>Lịch sử trò chuyện</h2>", unsafe_allow_html=True)
+        if st.button("➕ New chat"):
+            create_new_chat()
+        for chat_id in list(conversations.keys()):
+            chat_name = conversations[chat_id]
+            create_chat_button(chat_id)
+            if st.session_state.menu_states.get(chat_id, False):
+                with st.expander(f"Cài đặt cho '{chat_name}'", expanded=True):
+                    new_name = st.text_input(f"Đổi tên '{chat_name}' thành:", value="", placeholder=chat_name, key=f"rename_{chat_id}")
+                    if new_name and new_name != chat_name:
+                        if new_name not in conversations.values():
+                            if st.button("Đổi tên", key=f"rename_button_{chat_id}"):
+                                conversation_store.rename(chat_id, new_name)
+                                conversations[chat_id] = new_name
+                                st.session_state.menu_states[chat_id] = False
+                        else:
+                            st.warning(f"Tên '{new_name}' đã tồn tại.")
+                    if st.button("Xóa hội thoại", key=f"delete_button_{chat_id}"):
+                        if len(conversations) > 1:
+                            conversation_store.delete(chat_id)
+                            conversations.pop(chat_id)
+                            if st.session_state.selected_conversation == chat_id:
+                                select_chat(next(iter(conversations)))
+                            st.session_state.menu_states[chat_id] = False
+                        else:
+                            st.warning("Không thể xóa hội thoại cuối cùng.")
+        # Trạng thái mô hình: đang tải, đang cập nhật chỉ mục mới, lỗi hoặc sẵn sàng
+        if loader.error is not None:
+            st.error(f"Không tải được mô hình: {loader.error}")
+        elif llm_model is None:
+            st.caption(f"🟡 Đang tải chỉ mục... ({time.perf_counter() - loader.started:.0f}s)")
+        elif loader.loading:
+            st.caption("🟡 Đang tải chỉ mục mới, vẫn trả lời bằng chỉ mục cũ")
+        else:
+            st.caption("🟢 Sẵn sàng")
+        # Bảng quản trị: thời gian từng giai đoạn và các bộ đếm (token, cache)
+        with st.expander("Thống kê hiệu năng"):
+            if llm_model is not None:
+                footprint = llm_model.index_footprint()
+                st.caption(f"Chỉ mục {footprint['type']}: {footprint['vectors']} vector, "
+                           f"{(footprint['index_bytes'] or 0) / 2 ** 20:.1f} MB"
+                           f"{' (mmap, dùng chung giữa các tiến trình)' if footprint['mmap'] else ''}")
+            stage_rows, count_rows = get_metrics().snapshot()
+            if stage_rows:
+                st.dataframe(stage_rows, hide_index=True)
+                st.dataframe(count_rows, hide_index=True)
+            else:
+                st.caption("Chưa có số liệu.")
+
+    # Lấy hội thoại hiện tại
+    selected_chat = st.session_state.selected_conversation
+
+    if selected_chat:       
+        # Main chat area
+        st.header("🤖 Guru")
+        st.markdown("---")
+
+        # Chỉ dựng các tin nhắn mới nhất, tin cũ hơn được tải thêm theo từng trang
+        if conversation_store.count(selected_chat) > st.session_state.visible_messages:
+            if st.button("⬆ Xem tin nhắn cũ hơn"):
+                st.session_state.visible_messages += MESSAGE_PAGE_SIZE
+
+        # Hiển thị các tin nhắn của conversation hiện tại
+        for message in conversation_store.messages(selected_chat, st.session_state.visible_messages):
+            if message["role"] == "user":
+                st.markdown(f'<div class="user-message">{message["content"]}</div>', unsafe_allow_html=True)
+            else:
+                st.markdown(f'<div class="bot-message">{message["content"]}</div>', unsafe_allow_html=True)
+
+        async def display_typing_message(chunks):
+            full_res = ""
+            holder = st.empty()
+            render_seconds = 0.0
+            async for chunk in chunks:
+                # Hiển thị từng phần ngay khi mô hình sinh ra
+                full_res += chunk.replace('*', '')
+                start = time.perf_counter()
+                holder.markdown(f'<div class="bot-message">{full_res}▌</div>', unsafe_allow_html=True)
+                render_seconds += time.perf_counter() - start
+
+            holder.markdown(f'<div class="bot-message">{full_res}</div>', unsafe_allow_html=True)
+            # Thời gian Streamlit dựng giao diện, tính riêng với thời gian mô hình sinh câu trả lời
+            llm_model.metrics.observe('query', 'render', render_seconds)
+            conversation_store.append(selected_chat, "assistant", full_res)
+            return full_res
+
+        if llm_model is None and loader.error is None:
+            st.info("⏳ Đang tải chỉ mục, bạn có thể xem lại lịch sử trong lúc chờ...")
+
+        # Nhập tin nhắn của người dùng, chỉ mở khi mô hình đã sẵn sàng
+        if prompt := st.chat_input("Nhập tin nhắn của bạn...", disabled=llm_model is None):
+            st.markdown(f'<div class="user-message">{prompt}</div>', unsafe_allow_html=True)
+            conversation_store.append(selected_chat, "user", prompt)
+
+            async def answer(prompt):
+                # Chờ đến lượt trong hàng đợi chung, hiển thị vị trí hiện tại trong lúc chờ
+                status = st.empty()
+                sources, chunks = await llm_model.astream_query(
+                    prompt, user=st.session_state.user_id,
+                    on_wait=lambda position: status.info(f"Đang chờ đến lượt, vị trí trong hàng đợi: {position}"))
+                # Streamlit có thể dừng script giữa chừng (rerun), luôn đóng luồng để trả lại lượt trong hàng đợi
+                try:
+                    status.empty()
+                    return sources, await display_typing_message(chunks)
+                finally:
+                    await chunks.aclose()
+
+            sources, llm_reply = asyncio.run(answer(prompt))
+
+            # Đã được luồng nền import cùng mô hình
+            from chatbot import Get_id, Get_pages
+            ids = Get_id(sources, llm_reply)
+
+            # Bot phản hồi
+            if len(ids) > 0:
+                 pages = Get_pages(sources, ids[0]) if SHOW_ORIGIN_PAGES_ONLY else []
+                 display_pdf(ids[0], pages)
+            # else:
+            #     display_typing_message(prompt)
+
+    else:
+        st.title("Chưa chọn hội thoại!")
+        st.markdown("Hãy chọn hoặc tạo hội thoại mới từ sidebar.")
+
+    # Chạy lại trang cho đến khi mô hình tải xong, để ô nhập tin nhắn tự mở
+    if llm_model is None and loader.error is None:
+        time.sleep(LOADING_POLL_SECONDS)
+        st.rerun()
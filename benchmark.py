@@ -0,0 +1,329 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import faiss
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.llms import MockLLM
+from llama_index.core.schema import QueryBundle
+
+from chatbot import (Chatbot, DEFAULT_INDEX_CONFIG, INDEX_TYPES, VECTOR_BACKENDS, Metrics, build_faiss_index,
+                     iter_json_items, stored_vectors)
+
+# Offline benchmark: mock LLM and embeddings, a synthetic corpus scaled from data/, and a
+# labelled query set. Writes per-stage timings, latency percentiles, RSS and recall@k to JSON.
+#
+#   python benchmark.py --scale 20 --index-type ivf_flat --output bench.json
+#   python benchmark.py --scale 20 --index-type hnsw --baseline bench.json
+#   python benchmark.py --imports-only --check-budgets    # import times against IMPORT_BUDGETS
+
+# Seconds each module may take to import in a fresh interpreter. app is what a page load and a
+# server restart wait for before the first render; chatbot is paid on the background load.
+IMPORT_BUDGETS = {'app': 1.0, 'chatbot': 2.5}
+# Heavy modules the app must leave to the background load (or to the first PDF shown)
+DEFERRED_MODULES = ('llama_index.core', 'faiss', 'google.generativeai', 'streamlit_pdf_viewer', 'chatbot')
+
+TOPICS = ['Education', 'Environment', 'Technology', 'Health', 'History', 'Science', 'Travel', 'Work']
+QUESTION_TYPES = ['Multiple choice', 'True/False/Not given', 'Matching headings', 'Sentence completion']
+SKILLS = ['Reading', 'Listening', 'Speaking', 'Writing']
+WORDS = re.findall(r'\w+', ' '.join(TOPICS + QUESTION_TYPES) + (
+    ' climate ocean university student museum energy city river forest language memory sleep '
+    'robot coffee market island bridge desert music library vaccine satellite farming volcano '
+    'migration architecture festival glacier insect ancient modern research survey economy'))
+
+
+class HashEmbedding(BaseEmbedding):
+    # Deterministic bag-of-words embedding: related texts share dimensions, so recall is meaningful
+    dim: int = 384
+    calls: int = 0
+
+    def embed(self, text):
+        vector = np.zeros(self.dim, dtype='float32')
+        for token in re.findall(r'\w+', text.lower()):
+            vector[int(hashlib.md5(token.encode()).hexdigest()[:8], 16) % self.dim] += 1.0
+        norm = float(np.linalg.norm(vector)) or 1.0
+        return (vector / norm).tolist()
+
+    def _get_query_embedding(self, query):
+        self.calls += 1
+        return self.embed(query)
+
+    async def _aget_query_embedding(self, query):
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text):
+        self.calls += 1
+        return self.embed(text)
+
+
+def synthetic_item(rng, book_id):
+    topic = rng.choice(TOPICS)
+    words = rng.sample(WORDS, 12)
+    return {
+        'Title': f'{topic} {" ".join(words[:3])}'.title(),
+        'Topic': topic,
+        'Type of questions': rng.choice(QUESTION_TYPES),
+        'Origin': f'Practice book {rng.randint(1, 20)}, page {rng.randint(1, 150)}-{rng.randint(151, 300)}',
+        'ID': str(book_id),
+        'Skill': rng.choice(SKILLS),
+        'Content': ' '.join(rng.choice(words) for _ in range(rng.randint(60, 200))),
+    }
+
+
+def seed_items(data_dir):
+    items = []
+    if os.path.isdir(data_dir):
+        for file_name in sorted(os.listdir(data_dir)):
+            items.extend(iter_json_items(os.path.join(data_dir, file_name)))
+    return [item for item in items if isinstance(item, dict)]
+
+
+def build_corpus(data_dir, out_dir, scale, seed):
+    # Every seed item is copied scale times with a fresh ID and a quarter of its content words
+    # replaced, so copies are distinct documents; with no seed data the items are generated outright
+    rng = random.Random(seed)
+    seeds = seed_items(data_dir)
+    items = []
+    for copy in range(scale):
+        if not seeds:
+            items.extend(synthetic_item(rng, 100000 + copy * 100 + i) for i in range(100))
+            continue
+        for i, item in enumerate(seeds):
+            item = dict(item)
+            if copy:
+                item['ID'] = f'{item.get("ID", i)}-{copy}'
+                words = str(item.get('Content', '')).split()
+                for j in rng.sample(range(len(words)), len(words) // 4):
+                    words[j] = rng.choice(WORDS)
+                item['Content'] = ' '.join(words)
+            items.append(item)
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, 'corpus.json'), 'w', encoding='utf-8') as out:
+        json.dump(items, out, ensure_ascii=False)
+    return items
+
+
+def build_queries(items, count, seed):
+    # A query is the title plus a few content words of one item, labelled with that item's ID
+    rng = random.Random(seed + 1)
+    queries = []
+    for item in rng.sample(items, min(count, len(items))):
+        words = str(item.get('Content', '')).split()
+        start = rng.randint(0, max(len(words) - 8, 0))
+        queries.append({'query': f'{item.get("Title", "")} {" ".join(words[start:start + 8])}', 'ids': [str(item.get('ID'))]})
+    return queries
+
+
+def load_queries(path):
+    with open(path, 'r', encoding='utf-8') as inp:
+        return [json.loads(line) for line in inp if line.strip()]
+
+
+def rss_mb():
+    # Current RSS from /proc where available, peak RSS otherwise (ru_maxrss is KB on Linux)
+    try:
+        with open('/proc/self/statm') as inp:
+            return int(inp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    # ru_maxrss is in bytes on macOS and in KB elsewhere
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+
+
+def import_time(module, runs=3):
+    # Best of runs fresh interpreters, with the deferred modules the import pulled in
+    code = (f'import sys, time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start); '
+            f'print(",".join(m for m in {DEFERRED_MODULES!r} if m in sys.modules and m != {module!r}))')
+    seconds, loaded = [], ''
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-W', 'ignore', '-c', code], capture_output=True, text=True, check=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__))).stdout.splitlines()
+        seconds.append(float(out[0]))
+        loaded = out[1] if len(out) > 1 else ''
+    return {'seconds': min(seconds), 'budget': IMPORT_BUDGETS[module], 'deferred_loaded': loaded.split(',') if loaded else []}
+
+
+def check_imports(imports):
+    # The app must stay within its budget and leave the heavy modules to the background load
+    failures = []
+    for module, result in imports.items():
+        if result['seconds'] > result['budget']:
+            failures.append(f"import {module} took {result['seconds']:.2f}s, budget {result['budget']:.2f}s")
+    if imports.get('app', {}).get('deferred_loaded'):
+        failures.append(f"import app loaded {', '.join(imports['app']['deferred_loaded'])}")
+    return failures
+
+
+def percentiles(samples):
+    samples = np.asarray(samples) * 1000
+    return {
+        'count': len(samples),
+        'mean_ms': float(samples.mean()),
+        'p50_ms': float(np.percentile(samples, 50)),
+        'p95_ms': float(np.percentile(samples, 95)),
+        'p99_ms': float(np.percentile(samples, 99)),
+    }
+
+
+def book_ids(nodes):
+    return [str(node.node.metadata.get('book_id')) for node in nodes]
+
+
+def recall_at(ranked, expected, ks):
+    # Share of queries whose labelled ID is among the first k distinct retrieved IDs
+    hits = dict.fromkeys(ks, 0)
+    for ids, labels in zip(ranked, expected):
+        ids = list(dict.fromkeys(ids))
+        for k in ks:
+            hits[k] += any(label in ids[:k] for label in labels)
+    return {f'@{k}': hits[k] / max(len(ranked), 1) for k in ks}
+
+
+def run(args):
+    work_dir = tempfile.mkdtemp(prefix='bench-')
+    data_dir = os.path.join(work_dir, 'data')
+    persist_dir = os.path.join(work_dir, 'storage')
+    index_config = dict(DEFAULT_INDEX_CONFIG, type=args.index_type, mmap=args.mmap)
+    for key in ('nlist', 'nprobe', 'pq_m', 'pq_nbits', 'hnsw_m', 'ef_search'):
+        if getattr(args, key) is not None:
+            index_config[key] = getattr(args, key)
+    options = dict(persist_dir=persist_dir, index_config=index_config, chunk_size=args.chunk_size,
+                   chunk_overlap=args.chunk_overlap, retrieve_top_k=args.top_k, rerank_top_n=args.rerank_top_n,
+                   token_budget=args.token_budget, embed_cache=False, embed_workers=args.embed_workers,
+                   vector_backend=args.vector_backend)
+    results = {'config': dict(vars(args), index_config=index_config), 'stages': {}}
+    stages = results['stages']
+    try:
+        start = time.perf_counter()
+        items = build_corpus(args.data_dir, data_dir, args.scale, args.seed)
+        queries = load_queries(args.queries) if args.queries else build_queries(items, args.num_queries, args.seed)
+        stages['corpus'] = {'seconds': time.perf_counter() - start, 'documents': len(items),
+                            'queries': len(queries), 'rss_mb': rss_mb()}
+
+        embed_model = HashEmbedding(dim=args.dim, embed_batch_size=100)
+        llm = MockLLM(max_tokens=args.answer_tokens)
+        start = time.perf_counter()
+        chatbot = Chatbot(data_dir, rebuild=True, llm=llm, embed_model=embed_model, **options)
+        seconds = time.perf_counter() - start
+        nodes = len(chatbot.index.index_struct.nodes_dict)
+        stages['ingest'] = {'seconds': seconds, 'documents': len(items), 'nodes': nodes,
+                            'documents_per_s': len(items) / seconds, 'nodes_per_s': nodes / seconds,
+                            'embedding_calls': embed_model.calls, 'rss_mb': rss_mb()}
+
+        if args.vector_backend == 'faiss':
+            # Rebuild the FAISS index alone from the stored vectors, without embedding or parsing
+            vectors, _ = stored_vectors(chatbot.vector_store.client)
+            start = time.perf_counter()
+            built = build_faiss_index(index_config, vectors, chatbot.embed_dim)
+            built.add_with_ids(vectors, np.arange(len(vectors), dtype='int64'))
+            stages['index_build'] = {'seconds': time.perf_counter() - start, 'vectors': len(vectors),
+                                     'index_bytes': int(faiss.serialize_index(built).nbytes), 'rss_mb': rss_mb()}
+            del built
+
+        start = time.perf_counter()
+        metrics = Metrics()
+        chatbot = Chatbot(data_dir, llm=llm, embed_model=embed_model, metrics=metrics, **options)
+        stages['warm_load'] = dict(chatbot.index_footprint(), seconds=time.perf_counter() - start, rss_mb=rss_mb())
+
+        retrieve_times, query_times, retrieved, answered = [], [], [], []
+        for query in queries:
+            query_bundle = QueryBundle(query['query'], embedding=embed_model.get_query_embedding(query['query']))
+            start = time.perf_counter()
+            nodes = chatbot.retriever.retrieve(query_bundle)
+            retrieve_times.append(time.perf_counter() - start)
+            retrieved.append(book_ids(nodes))
+
+            # End to end through the response cache (cleared, so every query reaches the mock LLM)
+            chatbot.cache.clear()
+            start = time.perf_counter()
+            response = chatbot.query(query['query'])
+            query_times.append(time.perf_counter() - start)
+            answered.append(book_ids(response.source_nodes))
+        expected = [[str(label) for label in query['ids']] for query in queries]
+        ks = sorted({1, 5, args.top_k})
+        stages['retrieve'] = dict(percentiles(retrieve_times), rss_mb=rss_mb())
+        stages['query'] = dict(percentiles(query_times), rss_mb=rss_mb())
+        results['recall'] = {'retriever': recall_at(retrieved, expected, ks),
+                             'context': recall_at(answered, expected, sorted({1, args.rerank_top_n}))}
+        # Where the end-to-end query time goes, from the engine's own instrumentation
+        stage_rows, _ = metrics.snapshot()
+        results['query_stages'] = {row['stage']: {key: row[key] for key in ('mean_ms', 'p50_ms', 'p95_ms', 'p99_ms')}
+                                   for row in stage_rows if row['kind'] == 'query'}
+        results['peak_rss_mb'] = peak_rss_mb()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def flatten(results, prefix=''):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f'{prefix}{key}.')
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f'{prefix}{key}', value
+
+
+def compare(results, baseline):
+    keys = ('imports', 'stages', 'query_stages', 'recall', 'peak_rss_mb')
+    old = dict(flatten({k: baseline[k] for k in keys if k in baseline}))
+    for key, value in flatten({k: results[k] for k in keys if k in results}):
+        if old.get(key):
+            print(f'{key:45} {old[key]:12.3f} -> {value:12.3f} ({(value - old[key]) / old[key]:+.1%})')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the retrieval + generation pipeline')
+    parser.add_argument('--data-dir', default='data', help='seed items, scaled up into the synthetic corpus')
+    parser.add_argument('--scale', type=int, default=10, help='copies of each seed item')
+    parser.add_argument('--queries', help='JSON Lines file of {"query": ..., "ids": [book ids]}')
+    parser.add_argument('--num-queries', type=int, default=200, help='generated queries when --queries is not given')
+    parser.add_argument('--vector-backend', default='faiss', choices=sorted(VECTOR_BACKENDS))
+    parser.add_argument('--index-type', default=DEFAULT_INDEX_CONFIG['type'], choices=sorted(INDEX_TYPES))
+    for key in ('nlist', 'nprobe', 'pq_m', 'pq_nbits', 'hnsw_m', 'ef_search'):
+        parser.add_argument('--' + key.replace('_', '-'), type=int)
+    parser.add_argument('--mmap', action='store_true', help='load the persisted index memory-mapped')
+    parser.add_argument('--chunk-size', type=int, default=1024)
+    parser.add_argument('--chunk-overlap', type=int, default=64)
+    parser.add_argument('--top-k', type=int, default=20, help='retrieve_top_k')
+    parser.add_argument('--rerank-top-n', type=int, default=4)
+    parser.add_argument('--token-budget', type=int, default=2800)
+    parser.add_argument('--embed-workers', type=int, default=4)
+    parser.add_argument('--dim', type=int, default=384, help='mock embedding dimension')
+    parser.add_argument('--answer-tokens', type=int, default=64, help='mock LLM answer length')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--baseline', help='earlier --output file to compare against')
+    parser.add_argument('--imports-only', action='store_true', help='only measure the import times')
+    parser.add_argument('--check-budgets', action='store_true', help='exit with status 1 when over IMPORT_BUDGETS')
+    args = parser.parse_args()
+
+    imports = {module: import_time(module) for module in IMPORT_BUDGETS}
+    results = {'config': vars(args), 'imports': imports} if args.imports_only else dict(run(args), imports=imports)
+    with open(args.output, 'w', encoding='utf-8') as out:
+        json.dump(results, out, indent=2)
+    print(json.dumps({k: results[k] for k in ('imports', 'stages', 'query_stages', 'recall', 'peak_rss_mb') if k in results}, indent=2))
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as inp:
+            compare(results, json.load(inp))
+    failures = check_imports(imports)
+    for failure in failures:
+        print('Over budget:', failure)
+    if failures and args.check_budgets:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
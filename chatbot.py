@@ -0,0 +1,1585 @@
+import time
+import os
+import json
+import threading
+import ast
+import asyncio
+import functools
+import sqlite3
+import re
+import random
+import math
+import heapq
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from itertools import islice
+from collections import OrderedDict, Counter
+from operator import itemgetter
+import hashlib
+import importlib
+import numpy as np
+from llama_index.core import VectorStoreIndex, SimpleDirectoryReader, Document, PromptTemplate, StorageContext, load_index_from_storage
+from llama_index.core.node_parser import TokenTextSplitter, JSONNodeParser
+from llama_index.readers.json import JSONReader
+from llama_index.vector_stores.faiss import FaissMapVectorStore
+from llama_index.core.vector_stores import SimpleVectorStore
+from llama_index.core import Settings
+from llama_index.core.base.response.schema import Response
+from llama_index.core.schema import MetadataMode, QueryBundle, NodeWithScore
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.query_engine import RetrieverQueryEngine
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.utils import get_tokenizer
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.llms import CustomLLM
+from llama_index.core.base.embeddings.base import BaseEmbedding
+
+from metrics import current_trace, stage, count, in_context, Metrics
+from stores import INDEX_CONFIG_FILE
+
+
+class LazyModule:
+    # Stands in for a module and imports it on first attribute access, so processes that never
+    # use it (the simple backend, the web page before the index is loaded) never pay for it
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+
+faiss = LazyModule('faiss')
+
+PERSIST_FILES = ['default__vector_store.json', 'docstore.json', 'index_store.json']
+EMBED_CHECKPOINT_FILE = 'embedding_checkpoint.jsonl'
+NODE_CACHE_FILE = 'node_cache.sqlite'
+KEYWORD_INDEX_FILE = 'keyword_index.json'
+EMBED_CACHE_FILE = 'embedding_cache.sqlite'
+# Bump when the way read_data builds a Document changes, so stored documents are re-ingested
+DOCUMENT_VERSION = 2
+
+# Question-bank fields kept as node metadata, with the keys they appear under in data/
+METADATA_FIELDS = {
+    'title': ('title',),
+    'topic': ('topic', 'topics'),
+    'question_type': ('type of questions', 'question type', 'question_type', 'type'),
+    'origin': ('origin', 'source'),
+    'book_id': ('id', 'book id', 'book_id'),
+    'skill': ('skill',),
+}
+# Fields that get an exact-match filter in the keyword index
+FILTER_FIELDS = ('topic', 'question_type', 'skill')
+LOCAL_EMBED_MODEL = 'BAAI/bge-small-en-v1.5'
+GEMINI_LLM_MODEL = 'models/gemini-1.5-flash-latest'
+GEMINI_EMBED_MODEL = 'models/embedding-001'
+
+# FAISS factory strings for each supported index type
+INDEX_TYPES = {
+    'flat': 'Flat',
+    'ivf_flat': 'IVF{nlist},Flat',
+    'ivf_pq': 'IVF{nlist},PQ{pq_m}x{pq_nbits}',
+    'hnsw': 'HNSW{hnsw_m},Flat',
+    # Quantized storage: 1 byte per dimension (SQ8) or pq_m * pq_nbits bits per vector (PQ)
+    'sq8': 'SQ8',
+    'pq': 'PQ{pq_m}x{pq_nbits}',
+    'ivf_sq8': 'IVF{nlist},SQ8',
+}
+IVF_TYPES = ('ivf_flat', 'ivf_pq', 'ivf_sq8')
+# Types whose stored vectors reconstruct exactly, the others only keep quantized codes
+EXACT_TYPES = ('flat', 'ivf_flat', 'hnsw')
+# The index type of each FAISS class index_factory builds for INDEX_TYPES
+FAISS_CLASS_TYPES = {
+    'IndexFlat': 'flat', 'IndexFlatL2': 'flat', 'IndexIVFFlat': 'ivf_flat', 'IndexIVFPQ': 'ivf_pq',
+    'IndexHNSWFlat': 'hnsw', 'IndexScalarQuantizer': 'sq8', 'IndexPQ': 'pq', 'IndexIVFScalarQuantizer': 'ivf_sq8',
+}
+DEFAULT_INDEX_CONFIG = {
+    'type': 'flat',
+    'nlist': 1024,          # IVF: number of cells, capped by the size of the training set
+    'nprobe': 16,           # IVF: cells visited per query
+    'pq_m': 64,             # PQ: sub-quantizers, must divide the embedding dimension
+    'pq_nbits': 8,          # PQ: bits per sub-quantizer code
+    'hnsw_m': 32,           # HNSW: neighbours per graph node
+    'ef_construction': 200, # HNSW: search depth while building the graph
+    'ef_search': 64,        # HNSW: search depth per query
+    'mmap': False,          # Load the persisted index memory-mapped, so worker processes share one page-cached copy
+}
+# Settings that only affect loading and search, taken from the current configuration even when
+# a persisted index is served with the build settings it was made with
+QUERY_TIME_PARAMS = ('nprobe', 'ef_search', 'mmap')
+
+
+def read_index_config(persist_dir):
+    # What the persisted index was built with, see Chatbot.persist; None if nothing is persisted
+    path = os.path.join(persist_dir, INDEX_CONFIG_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as inp:
+        return json.load(inp)
+
+
+def index_key(config):
+    return INDEX_TYPES[config['type']].format(**config)
+
+
+def set_search_params(faiss_index, config):
+    # Query-time knobs are not part of the index key, so they can change without a rebuild
+    base = faiss.downcast_index(faiss_index.index)
+    if isinstance(base, faiss.IndexIVF):
+        base.nprobe = config['nprobe']
+    if isinstance(base, faiss.IndexHNSW):
+        base.hnsw.efSearch = config['ef_search']
+
+
+def training_size(config):
+    # Embeddings to collect before a trainable index can be created, the rest is streamed in
+    if config['type'] in ('ivf_flat', 'ivf_sq8'):
+        return 39 * config['nlist']
+    if config['type'] == 'ivf_pq':
+        return 39 * max(config['nlist'], 2 ** config['pq_nbits'])
+    if config['type'] == 'pq':
+        return 39 * 2 ** config['pq_nbits']
+    if config['type'] == 'sq8':
+        # SQ8 only learns the value range of each dimension
+        return 10000
+    return 0
+
+
+def mmap_flags(config):
+    # Read flags that leave the vectors in the persisted file, shared through the page cache by
+    # every process that maps it. IVF maps its inverted lists, the other types their code array.
+    if not config['mmap']:
+        return 0
+    return faiss.IO_FLAG_MMAP if config['type'] in IVF_TYPES else faiss.IO_FLAG_MMAP_IFC
+
+
+def min_training_vectors(config):
+    # Fewer vectors than this and build_faiss_index falls back to a flat index. PQ learns
+    # 2**pq_nbits centroids per sub-quantizer and wants ~39 training points for each.
+    return {'ivf_flat': 1, 'ivf_sq8': 1, 'sq8': 1, 'ivf_pq': 39 * 2 ** config['pq_nbits'],
+            'pq': 39 * 2 ** config['pq_nbits']}.get(config['type'], 0)
+
+
+def build_faiss_index(config, vectors, dim):
+    # With too few vectors the index built is smaller than config asks for (fewer IVF cells, or
+    # flat). built_config() tells what was built, and Chatbot.insert_data retrains it later.
+    config = dict(config)
+    if config['type'] in IVF_TYPES:
+        # k-means wants ~39 training points per cell
+        config['nlist'] = max(1, min(config['nlist'], len(vectors) // 39))
+    if len(vectors) < min_training_vectors(config):
+        print(f"Only {len(vectors)} vectors, too few to train {config['type']}; using a flat index")
+        config['type'] = 'flat'
+    base = faiss.index_factory(dim, index_key(config))
+    if isinstance(base, faiss.IndexHNSW):
+        base.hnsw.efConstruction = config['ef_construction']
+    if not base.is_trained:
+        base.train(vectors)
+    faiss_index = faiss.IndexIDMap2(base)
+    set_search_params(faiss_index, config)
+    return faiss_index
+
+
+def built_config(faiss_index, config):
+    # config as the index was actually built, read from the index itself
+    base = faiss.downcast_index(faiss_index.index)
+    built = dict(config, type=FAISS_CLASS_TYPES[type(base).__name__])
+    if isinstance(base, faiss.IndexIVF):
+        built['nlist'] = base.nlist
+    return built
+
+
+def stored_vectors(faiss_index):
+    # The vectors of an IndexIDMap2 in insertion order, with their ids. IVF indexes
+    # need a temporary direct map to reconstruct by position.
+    base = faiss.downcast_index(faiss_index.index)
+    if isinstance(base, faiss.IndexIVF):
+        base.make_direct_map()
+    vectors = base.reconstruct_n(0, base.ntotal)
+    if isinstance(base, faiss.IndexIVF):
+        base.set_direct_map_type(faiss.DirectMap.NoMap)
+    return vectors, faiss.vector_to_array(faiss_index.id_map)
+
+
+class FaissIdMapVectorStore(FaissMapVectorStore):
+    # FaissMapVectorStore hands out ntotal as the next id, which collides with
+    # a live id once something has been deleted. Allocate past the largest id instead.
+    _mmap_path = PrivateAttr(default=None)
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir, mmap_flags=0):
+        # See mmap_flags(); a mapped index is paged in from the file on demand
+        path = os.path.join(persist_dir, PERSIST_FILES[0])
+        store = cls(faiss_index=faiss.read_index(path, mmap_flags))
+        with open(os.path.join(persist_dir, 'id_map.json'), 'r', encoding='utf-8') as inp:
+            id_map = ast.literal_eval(inp.read())
+        store._node_id_to_faiss_id_map = id_map['node_id_to_faiss_id_map']
+        store._faiss_id_to_node_id_map = id_map['faiss_id_to_node_id_map']
+        store._mmap_path = path if mmap_flags else None
+        return store
+
+    @property
+    def mapped(self):
+        return self._mmap_path is not None
+
+    def load_writable(self):
+        # A mapped index is read-only (writing to a mapped code array aborts the process), so
+        # the first add or delete swaps in a private in-memory copy of the persisted file
+        if self._mmap_path is None:
+            return
+        old_base = faiss.downcast_index(self._faiss_index.index)
+        self._faiss_index = faiss.read_index(self._mmap_path)
+        self._mmap_path = None
+        base = faiss.downcast_index(self._faiss_index.index)
+        if isinstance(base, faiss.IndexIVF):
+            base.nprobe = old_base.nprobe
+        if isinstance(base, faiss.IndexHNSW):
+            base.hnsw.efSearch = old_base.hnsw.efSearch
+
+    def persist(self, persist_path, fs=None):
+        # Written next to the old file and renamed over it, so processes that still map
+        # the old file keep reading it instead of seeing it truncated under them
+        super().persist(persist_path=persist_path + '.tmp', fs=fs)
+        os.replace(persist_path + '.tmp', persist_path)
+
+    def add(self, nodes, **add_kwargs):
+        self.load_writable()
+        next_id = max(self._faiss_id_to_node_id_map, default=-1) + 1
+        new_ids = []
+        for node in nodes:
+            embedding = np.array(node.get_embedding(), dtype='float32')[np.newaxis, :]
+            self._faiss_index.add_with_ids(embedding, np.array([next_id], dtype=np.int64))
+            self._node_id_to_faiss_id_map[node.id_] = next_id
+            self._faiss_id_to_node_id_map[next_id] = node.id_
+            new_ids.append(node.id_)
+            next_id += 1
+        return new_ids
+
+    def delete(self, ref_doc_id, **delete_kwargs):
+        # The base class calls remove_ids directly, which only a flat index supports
+        self.delete_nodes([ref_doc_id], **delete_kwargs)
+
+    def delete_nodes(self, node_ids=None, filters=None, **delete_kwargs):
+        if filters is not None or node_ids is None:
+            return super().delete_nodes(node_ids, filters, **delete_kwargs)
+        node_ids = {node_id for node_id in node_ids if node_id in self._node_id_to_faiss_id_map}
+        if not node_ids:
+            return
+        self.load_writable()
+        if isinstance(faiss.downcast_index(self._faiss_index.index), faiss.IndexFlat):
+            super().delete_nodes(list(node_ids), **delete_kwargs)
+        else:
+            # IndexIDMap2.remove_ids only works over a flat index (HNSW cannot remove at all,
+            # IVF breaks the id map), so rebuild the index from the vectors that stay. That is
+            # O(index size) per call: callers must pass all the nodes to delete at once, as
+            # Chatbot.insert_data does.
+            self.rebuild_without(node_ids)
+
+    def retrain(self, config, embed):
+        # Builds the index for config from the stored vectors, under the same ids. A quantized
+        # index only holds approximations, and codebooks learnt from them lose recall, so its
+        # vectors come from embed (node ids -> exact embeddings) instead.
+        self.load_writable()
+        vectors, ids = stored_vectors(self._faiss_index)
+        if built_config(self._faiss_index, config)['type'] not in EXACT_TYPES:
+            node_ids = [self._faiss_id_to_node_id_map[int(i)] for i in ids]
+            vectors = np.asarray(embed(node_ids), dtype='float32')
+        new_index = build_faiss_index(config, vectors, self._faiss_index.d)
+        new_index.add_with_ids(vectors, ids)
+        self._faiss_index = new_index
+
+    def rebuild_without(self, node_ids):
+        old_base = faiss.downcast_index(self._faiss_index.index)
+        vectors, ids = stored_vectors(self._faiss_index)
+        keep = np.array([self._faiss_id_to_node_id_map[int(i)] not in node_ids for i in ids], dtype=bool)
+        # Keeps the trained quantizers, only the stored vectors are dropped
+        base = faiss.clone_index(old_base)
+        base.reset()
+        new_index = faiss.IndexIDMap2(base)
+        if keep.any():
+            new_index.add_with_ids(vectors[keep], ids[keep])
+        self._faiss_index = new_index
+        self._faiss_id_to_node_id_map = {int(i): self._faiss_id_to_node_id_map[int(i)] for i in ids[keep]}
+        self._node_id_to_faiss_id_map = {node_id: faiss_id for faiss_id, node_id in self._faiss_id_to_node_id_map.items()}
+
+
+class FaissBackend:
+    # Vector store backends build, load and describe the store the index keeps its embeddings in.
+    # FAISS covers in-memory and, with mmap in the config, on-disk storage.
+    def __init__(self, config):
+        self.config = config
+
+    def key(self):
+        return index_key(self.config)
+
+    def built_key(self, vector_store):
+        return index_key(built_config(vector_store.client, self.config))
+
+    def needs_retrain(self, vector_store):
+        # An index built from too few vectors is rebuilt as configured once there are enough:
+        # the flat fallback once it can be trained, capped IVF once 4x the cells are possible.
+        # A trained index holding fewer vectors than its training needs (PQ built before the
+        # minimum was raised) goes back to flat until then.
+        built = built_config(vector_store.client, self.config)
+        count = vector_store.client.ntotal
+        if built['type'] != self.config['type']:
+            return count >= max(1, min_training_vectors(self.config))
+        if 0 < count < min_training_vectors(self.config):
+            return True
+        if self.config['type'] in IVF_TYPES:
+            return built['nlist'] * 4 <= min(self.config['nlist'], count // 39)
+        return False
+
+    def retrain(self, vector_store, embed):
+        vector_store.retrain(self.config, embed)
+
+    def training_size(self):
+        return training_size(self.config)
+
+    def create(self, vectors, dim):
+        return FaissIdMapVectorStore(faiss_index=build_faiss_index(self.config, vectors, dim))
+
+    def load(self, persist_dir):
+        vector_store = FaissIdMapVectorStore.from_persist_dir(persist_dir, mmap_flags(self.config))
+        set_search_params(vector_store.client, self.config)
+        return vector_store
+
+    def shape(self, vector_store):
+        return vector_store.client.ntotal, vector_store.client.d
+
+    def mapped(self, vector_store):
+        return vector_store.mapped
+
+
+class SimpleBackend:
+    # llama-index's SimpleVectorStore: exact search over a dict of embeddings, persisted as JSON.
+    # Needs no FAISS, fine for small corpora.
+    def __init__(self, config):
+        self.config = config
+
+    def key(self):
+        return 'simple'
+
+    def built_key(self, vector_store):
+        return 'simple'
+
+    def needs_retrain(self, vector_store):
+        return False
+
+    def retrain(self, vector_store, embed):
+        pass
+
+    def training_size(self):
+        return 0
+
+    def create(self, vectors, dim):
+        return SimpleVectorStore()
+
+    def load(self, persist_dir):
+        return SimpleVectorStore.from_persist_dir(persist_dir)
+
+    def shape(self, vector_store):
+        embeddings = vector_store.data.embedding_dict
+        return len(embeddings), len(next(iter(embeddings.values()), []))
+
+    def mapped(self, vector_store):
+        return False
+
+
+VECTOR_BACKENDS = {'faiss': FaissBackend, 'simple': SimpleBackend}
+
+
+class ResponseCache:
+    # Two tiers: exact match on the normalized prompt, then cosine similarity against
+    # the embeddings of cached prompts. Entries expire after ttl seconds and the least
+    # recently used one is evicted once max_size is reached.
+    def __init__(self, max_size=512, ttl=3600, threshold=0.95):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        self.entries = OrderedDict()  # normalized prompt -> (response, unit embedding, time)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def normalize(prompt):
+        return re.sub(r'\s+', ' ', prompt).strip(' ?!.').lower()
+
+    def get(self, prompt):
+        key = self.normalize(prompt)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[2] > self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def get_similar(self, embedding):
+        query = np.asarray(embedding, dtype='float32')
+        query /= np.linalg.norm(query) or 1.0
+        now = time.time()
+        with self.lock:
+            for key in [key for key, entry in self.entries.items() if now - entry[2] > self.ttl]:
+                del self.entries[key]
+            if not self.entries:
+                return None
+            keys = list(self.entries)
+            scores = np.stack([self.entries[key][1] for key in keys]) @ query
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                return None
+            self.entries.move_to_end(keys[best])
+            return self.entries[keys[best]][0]
+
+    def put(self, prompt, embedding, response):
+        vector = np.asarray(embedding, dtype='float32')
+        vector /= np.linalg.norm(vector) or 1.0
+        key = self.normalize(prompt)
+        with self.lock:
+            self.entries[key] = (response, vector, time.time())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def tokenize(text):
+    return re.findall(r'\w+', text.lower())
+
+
+def extract_metadata(item):
+    if not isinstance(item, dict):
+        return {}
+    keys = {str(key).strip().lower(): key for key in item}
+    metadata = {}
+    for field, aliases in METADATA_FIELDS.items():
+        for alias in aliases:
+            if alias in keys:
+                value = item[keys[alias]]
+                metadata[field] = ', '.join(map(str, value)) if isinstance(value, list) else str(value)
+                break
+    if 'skill' not in metadata:
+        text = json.dumps(item).lower()
+        if 'speaking' in text:
+            metadata['skill'] = 'Speaking'
+        elif 'reading' in text or 'question_type' in metadata:
+            metadata['skill'] = 'Reading'
+    return metadata
+
+
+def field_values(value):
+    # Normalized filter values of one metadata field, lists were stored comma separated
+    if not value:
+        return []
+    return [' '.join(tokenize(part)) for part in str(value).split(',') if tokenize(part)]
+
+
+class KeywordIndex:
+    # In-memory BM25 index over node text, plus inverted lists from each value of the
+    # FILTER_FIELDS to the nodes that have it
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}  # token -> {node_id: term frequency}
+        self.lengths = {}   # node_id -> number of tokens
+        self.total_length = 0
+        self.fields = {field: {} for field in FILTER_FIELDS}  # field -> value -> set of node_ids
+
+    def add(self, nodes):
+        for node in nodes:
+            tokens = tokenize(node.get_content(metadata_mode=MetadataMode.NONE))
+            self.lengths[node.node_id] = len(tokens)
+            self.total_length += len(tokens)
+            for token, freq in Counter(tokens).items():
+                self.postings.setdefault(token, {})[node.node_id] = freq
+            for field in FILTER_FIELDS:
+                for value in field_values(node.metadata.get(field)):
+                    self.fields[field].setdefault(value, set()).add(node.node_id)
+
+    def remove(self, node_ids):
+        node_ids = set(node_ids) & self.lengths.keys()
+        if not node_ids:
+            return
+        for node_id in node_ids:
+            self.total_length -= self.lengths.pop(node_id)
+        for token in list(self.postings):
+            posting = self.postings[token]
+            for node_id in node_ids & posting.keys():
+                del posting[node_id]
+            if not posting:
+                del self.postings[token]
+        for values in self.fields.values():
+            for value in list(values):
+                values[value] -= node_ids
+                if not values[value]:
+                    del values[value]
+
+    def idf(self, token):
+        n = len(self.lengths)
+        df = len(self.postings.get(token, ()))
+        return math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+    def match_filters(self, query):
+        # Field values that appear word for word in the query, e.g. "matching headings"
+        text = ' ' + ' '.join(tokenize(query)) + ' '
+        filters = {}
+        for field, values in self.fields.items():
+            matched = [value for value in values if f' {value} ' in text]
+            if matched:
+                filters[field] = matched
+        return filters
+
+    def filter_ids(self, filters):
+        # Values of one field are OR-ed, different fields are AND-ed. None means no filter.
+        allowed = None
+        for field, values in filters.items():
+            ids = set().union(*(self.fields[field].get(value, set()) for value in values))
+            allowed = ids if allowed is None else allowed & ids
+        return allowed
+
+    def search(self, query, allowed=None, top_k=10):
+        if not self.lengths:
+            return []
+        n = len(self.lengths)
+        average_length = self.total_length / n or 1
+        scores = {}
+        for token in set(tokenize(query)):
+            posting = self.postings.get(token)
+            if not posting:
+                continue
+            idf = self.idf(token)
+            for node_id, tf in posting.items():
+                if allowed is not None and node_id not in allowed:
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[node_id] / average_length)
+                scores[node_id] = scores.get(node_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        return heapq.nlargest(top_k, scores.items(), key=itemgetter(1))
+
+    def save(self, path):
+        fields = {field: {value: sorted(ids) for value, ids in values.items()} for field, values in self.fields.items()}
+        with open(path, 'w', encoding='utf-8') as out:
+            json.dump({'postings': self.postings, 'lengths': self.lengths, 'fields': fields}, out)
+
+    @classmethod
+    def load(cls, path):
+        keywords = cls()
+        with open(path, 'r', encoding='utf-8') as inp:
+            data = json.load(inp)
+        keywords.postings = data['postings']
+        keywords.lengths = data['lengths']
+        keywords.total_length = sum(keywords.lengths.values())
+        for field, values in data['fields'].items():
+            keywords.fields[field] = {value: set(ids) for value, ids in values.items()}
+        return keywords
+
+
+class HybridRetriever(BaseRetriever):
+    # Fuses the FAISS results with BM25 results by reciprocal rank. Field values named in the
+    # query (topic, question type, skill) become exact filters on both lists.
+    def __init__(self, vector_retriever, keywords, docstore, top_k=10, rrf_k=60):
+        self.vector_retriever = vector_retriever
+        self.keywords = keywords
+        self.docstore = docstore
+        self.top_k = top_k
+        self.rrf_k = rrf_k
+        super().__init__()
+
+    def _retrieve(self, query_bundle):
+        query = query_bundle.query_str
+        with stage('keyword_search'):
+            allowed = self.keywords.filter_ids(self.keywords.match_filters(query))
+        with stage('vector_search'):
+            vector_nodes = self.vector_retriever.retrieve(query_bundle)
+        vector_ids = [n.node.node_id for n in vector_nodes if allowed is None or n.node.node_id in allowed]
+        with stage('keyword_search'):
+            keyword_ids = [node_id for node_id, _ in self.keywords.search(query, allowed, self.top_k)]
+        scores = {}
+        for ranked in (vector_ids, keyword_ids):
+            for rank, node_id in enumerate(ranked):
+                scores[node_id] = scores.get(node_id, 0.0) + 1.0 / (self.rrf_k + rank + 1)
+        if allowed is not None and len(scores) < self.top_k:
+            # Pure filter lookups ("all Matching Headings questions") are filled from the filter itself
+            for node_id in sorted(allowed - scores.keys())[:self.top_k - len(scores)]:
+                scores[node_id] = 0.0
+        nodes = {n.node.node_id: n.node for n in vector_nodes}
+        best = heapq.nlargest(self.top_k, scores.items(), key=itemgetter(1))
+        return [NodeWithScore(node=nodes.get(node_id) or self.docstore.get_node(node_id), score=score) for node_id, score in best]
+
+
+class CachedTokenTextSplitter(TokenTextSplitter):
+    # Remembers the splits of every text it has tokenized, keyed by the text and the splitter
+    # settings, so re-ingesting an unchanged document (e.g. after a rebuild) skips tokenization
+    _conn = PrivateAttr(default=None)
+    _lock = PrivateAttr(default_factory=threading.Lock)
+
+    def open_cache(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS splits (key TEXT PRIMARY KEY, splits TEXT)')
+
+    def cache_key(self, text, metadata_str):
+        settings = json.dumps([self.chunk_size, self.chunk_overlap, self.separator, self.backup_separators])
+        return content_hash(settings + '\0' + metadata_str + '\0' + text)
+
+    def split_text_metadata_aware(self, text, metadata_str):
+        if self._conn is None:
+            return super().split_text_metadata_aware(text, metadata_str)
+        key = self.cache_key(text, metadata_str)
+        with self._lock:
+            row = self._conn.execute('SELECT splits FROM splits WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            count('split_cache_hits')
+            return json.loads(row[0])
+        count('split_cache_misses')
+        splits = super().split_text_metadata_aware(text, metadata_str)
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO splits VALUES (?, ?)', (key, json.dumps(splits)))
+        return splits
+
+    def commit(self):
+        if self._conn is not None:
+            with self._lock:
+                self._conn.commit()
+
+
+class CachedEmbedding(BaseEmbedding):
+    # Wraps another embedding model with an on-disk cache of text (ingest) embeddings keyed by
+    # model and text hash. Only the texts that miss are sent to the wrapped model, still in one
+    # batch. Query embeddings are not stored: every distinct question would grow the file and
+    # take the write lock ingest.py needs, and repeated questions hit the ResponseCache first.
+    _model = PrivateAttr()
+    _conn = PrivateAttr()
+    _lock = PrivateAttr(default_factory=threading.Lock)
+
+    def __init__(self, model, path):
+        super().__init__(model_name=model.model_name, embed_batch_size=model.embed_batch_size)
+        self._model = model
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)')
+
+    def cached(self, kind, texts, embed):
+        keys = [content_hash(f'{self.model_name}\0{kind}\0{text}') for text in texts]
+        with self._lock:
+            found = {}
+            for key in set(keys):
+                row = self._conn.execute('SELECT vector FROM embeddings WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    found[key] = np.frombuffer(row[0], dtype='float32').tolist()
+        missing = [i for i, key in enumerate(keys) if key not in found]
+        count('embedding_cache_hits', len(keys) - len(missing))
+        count('embedding_cache_misses', len(missing))
+        if missing:
+            for i, embedding in zip(missing, embed([texts[i] for i in missing])):
+                found[keys[i]] = embedding
+            with self._lock:
+                self._conn.executemany('INSERT OR REPLACE INTO embeddings VALUES (?, ?)',
+                                       [(keys[i], np.asarray(found[keys[i]], dtype='float32').tobytes()) for i in missing])
+                self._conn.commit()
+        return [found[key] for key in keys]
+
+    def _get_query_embedding(self, query):
+        return self._model.get_query_embedding(query)
+
+    async def _aget_query_embedding(self, query):
+        return await self._model.aget_query_embedding(query)
+
+    def _get_text_embedding(self, text):
+        return self._get_text_embeddings([text])[0]
+
+    def _get_text_embeddings(self, texts):
+        return self.cached('text', texts, self._model.get_text_embedding_batch)
+
+
+class LazyEmbedding(BaseEmbedding):
+    # Creates the embedding model (and its client) from factory on the first call. Until then
+    # only model_name is known, which is all a start from the persisted index and the cache needs.
+    _factory = PrivateAttr()
+    _model = PrivateAttr(default=None)
+    _lock = PrivateAttr(default_factory=threading.Lock)
+
+    def __init__(self, factory, model_name, embed_batch_size=10):
+        super().__init__(model_name=model_name, embed_batch_size=embed_batch_size)
+        self._factory = factory
+
+    def model(self):
+        with self._lock:
+            if self._model is None:
+                self._model = self._factory()
+            return self._model
+
+    def _get_query_embedding(self, query):
+        return self.model().get_query_embedding(query)
+
+    async def _aget_query_embedding(self, query):
+        return await self.model().aget_query_embedding(query)
+
+    def _get_text_embedding(self, text):
+        return self.model().get_text_embedding(text)
+
+    def _get_text_embeddings(self, texts):
+        return self.model().get_text_embedding_batch(texts)
+
+
+def gemini_embedding(embed_batch_size):
+    from llama_index.embeddings.gemini import GeminiEmbedding
+
+    class BatchGeminiEmbedding(GeminiEmbedding):
+        # GeminiEmbedding sends one embed_content request per text. Given the list,
+        # google-generativeai sends batchEmbedContents requests of up to 100 texts instead.
+        def _get_text_embeddings(self, texts):
+            return self._model.embed_content(model=self.model_name, content=texts, title=self.title,
+                                             task_type=self.task_type, request_options=self._request_options)['embedding']
+
+    return BatchGeminiEmbedding(api_key=os.environ["GOOGLE_API_KEY"], model_name=GEMINI_EMBED_MODEL,
+                                embed_batch_size=embed_batch_size)
+
+
+def local_embedding(model_name, embed_batch_size):
+    # Runs on CPU with no network round-trip, needs llama-index-embeddings-huggingface
+    from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+    return HuggingFaceEmbedding(model_name=model_name, device='cpu', embed_batch_size=embed_batch_size)
+
+
+# Between the items of a JSON array, and what may follow an item
+JSON_SEPARATORS = re.compile(r'[ \t\n\r,]*')
+JSON_DELIMITERS = ' \t\n\r,]'
+
+
+def iter_json_items(path, chunk_size=1 << 16):
+    # Yields the items of a top-level JSON array (or JSON Lines file) one at a time,
+    # without loading the whole file
+    with open(path, 'r', encoding='utf-8') as inp:
+        if path.endswith('.jsonl'):
+            for line in inp:
+                if line.strip():
+                    yield json.loads(line)
+            return
+        buffer = inp.read(chunk_size).lstrip()
+        if not buffer:
+            return
+        if not buffer.startswith('['):
+            data = json.loads(buffer + inp.read())
+            yield from (data if isinstance(data, list) else [data])
+            return
+        decoder = json.JSONDecoder()
+        pos = 1
+        eof = False
+        while True:
+            pos = JSON_SEPARATORS.match(buffer, pos).end()
+            if pos < len(buffer):
+                if buffer[pos] == ']':
+                    return
+                try:
+                    item, end = decoder.raw_decode(buffer, pos)
+                    # Only complete once a delimiter follows: a number at the end of the buffer
+                    # ('12', '12.', '1e') may continue in the next chunk
+                    complete = eof or (end < len(buffer) and buffer[end] in JSON_DELIMITERS)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    complete = False
+                if complete:
+                    yield item
+                    pos = end
+                    continue
+            elif eof:
+                raise json.JSONDecodeError('Unterminated array', buffer, pos)
+            # Drop what was consumed only when reading, not once per item
+            chunk = inp.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def is_rate_limit_error(e):
+    # google.api_core raises ResourceExhausted (HTTP 429) when the embedding quota is used up
+    return type(e).__name__ in ('ResourceExhausted', 'TooManyRequests') or '429' in str(e) or 'quota' in str(e).lower()
+
+
+class EmbeddingPipeline:
+    # Embeds nodes in fixed-size batches on a bounded thread pool. With checkpoint, every finished
+    # batch is appended to a checkpoint file, so an interrupted build only re-embeds what is
+    # missing. A CachedEmbedding model already keeps every batch it embeds, so it needs none.
+    def __init__(self, embed_model, checkpoint_path, batch_size=100, workers=4, max_retries=6, checkpoint=True):
+        self.embed_model = embed_model
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        self.workers = workers
+        self.max_retries = max_retries
+        self.done = None
+
+    def embed_batch(self, texts):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self.embed_model.get_text_embedding_batch(texts)
+            except Exception as e:
+                if attempt == self.max_retries or not is_rate_limit_error(e):
+                    raise
+                delay = min(60, 2 ** attempt) + random.random()
+                print(f'Rate limited, retrying in {delay:.1f}s')
+                time.sleep(delay)
+
+    def load_checkpoint(self):
+        done = {}
+        if not self.checkpoint or not os.path.exists(self.checkpoint_path):
+            return done
+        with open(self.checkpoint_path, 'r', encoding='utf-8') as inp:
+            for line in inp:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line may be cut short if the build was killed mid-write
+                    continue
+                done[record['hash']] = record['embedding']
+        return done
+
+    def open_checkpoint(self):
+        if not self.checkpoint:
+            return nullcontext()
+        os.makedirs(os.path.dirname(self.checkpoint_path) or '.', exist_ok=True)
+        return open(self.checkpoint_path, 'a', encoding='utf-8')
+
+    def clear_checkpoint(self):
+        # Also removes one left by a run that had the checkpoint on
+        self.done = None
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+    def run(self, nodes):
+        if self.done is None:
+            self.done = self.load_checkpoint()
+        pending = []
+        for node in nodes:
+            text = node.get_content(metadata_mode=MetadataMode.EMBED)
+            key = content_hash(text)
+            if key in self.done:
+                node.embedding = self.done.pop(key)
+            else:
+                pending.append((node, text, key))
+        if len(pending) < len(nodes):
+            print('Resuming from checkpoint:', len(nodes) - len(pending), 'nodes already embedded')
+            count('checkpoint_nodes', len(nodes) - len(pending))
+        batches = [pending[i:i + self.batch_size] for i in range(0, len(pending), self.batch_size)]
+        if not batches:
+            return
+        with ThreadPoolExecutor(max_workers=self.workers) as pool, self.open_checkpoint() as out:
+            futures = {pool.submit(in_context(self.embed_batch, [text for _, text, _ in batch])): batch for batch in batches}
+            try:
+                for finished, future in enumerate(as_completed(futures), 1):
+                    batch = futures[future]
+                    for (node, _, key), embedding in zip(batch, future.result()):
+                        node.embedding = embedding
+                        if out is not None:
+                            out.write(json.dumps({'hash': key, 'embedding': embedding}) + '\n')
+                    if out is not None:
+                        out.flush()
+                    print(f'Embedded batch {finished}/{len(batches)}')
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                raise
+
+
+class RequestQueue:
+    # Admits at most max_active requests at once across every session thread and event loop.
+    # Requests are served in arrival order, but a user only ever has one running at a time.
+    def __init__(self, max_active=8):
+        self.max_active = max_active
+        self.lock = threading.Lock()
+        self.running = Counter()
+        self.waiting = []  # (user, loop, future) in arrival order
+
+    def grant(self):
+        # Called with the lock held
+        while sum(self.running.values()) < self.max_active:
+            entry = next((entry for entry in self.waiting if not self.running[entry[0]]), None)
+            if entry is None:
+                break
+            self.waiting.remove(entry)
+            self.running[entry[0]] += 1
+            entry[1].call_soon_threadsafe(lambda future: future.done() or future.set_result(None), entry[2])
+
+    def position(self, entry):
+        with self.lock:
+            return self.waiting.index(entry) + 1 if entry in self.waiting else 0
+
+    async def acquire(self, user, on_wait=None):
+        # on_wait is called with the 1-based queue position whenever it changes
+        loop = asyncio.get_running_loop()
+        entry = (user, loop, loop.create_future())
+        with self.lock:
+            self.waiting.append(entry)
+            self.grant()
+        shown = None
+        try:
+            while not entry[2].done():
+                position = self.position(entry)
+                if on_wait is not None and position and position != shown:
+                    shown = position
+                    on_wait(position)
+                await asyncio.wait({entry[2]}, timeout=0.5)
+        except BaseException:
+            with self.lock:
+                granted = entry not in self.waiting
+                if not granted:
+                    self.waiting.remove(entry)
+            if granted:
+                self.release(user)
+            raise
+
+    def release(self, user):
+        with self.lock:
+            self.running[user] -= 1
+            if not self.running[user]:
+                del self.running[user]
+            self.grant()
+
+
+class Chatbot:
+    def __init__(self, data_dir, persist_dir='storage', rebuild=False, index_config=None,
+                 cache_size=512, cache_ttl=3600, cache_threshold=0.95,
+                 embed_batch_size=100, embed_workers=4, embed_max_retries=6, ingest_batch_size=256,
+                 retrieve_top_k=20, rerank_top_n=4, token_budget=2800, reranker='lexical',
+                 embed_backend='gemini', local_embed_model=LOCAL_EMBED_MODEL, embed_cache=True,
+                 max_concurrency=8, chunk_size=1024, chunk_overlap=64, llm=None, embed_model=None, metrics=None,
+                 vector_backend='faiss', ingest=True):
+        # Per-stage timings and counts of every query and ingest run, see Metrics
+        self.metrics = metrics or Metrics()
+        # With ingest=False the persisted index is served the way it was built (by ingest.py or an
+        # earlier run): its index type and embedding model, only the query-time settings come from here
+        stored = read_index_config(persist_dir)
+        persisted = stored if not ingest and not rebuild else None
+        if persisted is not None:
+            current = dict(DEFAULT_INDEX_CONFIG, **(index_config or {}))
+            index_config = dict(persisted['config'], **{key: current[key] for key in QUERY_TIME_PARAMS})
+            if embed_model is None:
+                embed_backend = 'gemini' if persisted['embed_model'] == GEMINI_EMBED_MODEL else 'local'
+                local_embed_model = persisted['embed_model']
+        google_gemini_api = 'PLEASE ADD GEMINI API KEY HERE'
+        os.environ["GOOGLE_API_KEY"] = google_gemini_api
+        os.environ["MODEL_NAME"] = GEMINI_LLM_MODEL
+        # LLM model, llm and embed_model override the Gemini defaults (the benchmark passes mocks).
+        # The default clients are created on first use, see the llm property and LazyEmbedding: a
+        # start from the persisted index imports no client library and makes no remote call.
+        self._llm = llm
+        self.client_lock = threading.RLock()
+        # embed_batch_size is the number of texts per embedding request (up to 100 for Gemini), and
+        # per checkpoint write of EmbeddingPipeline. embed_cache keeps every embedding in a sqlite
+        # cache that also lets an interrupted build resume, so the checkpoint is only written without it.
+        if embed_model is not None:
+            self.embed_model = embed_model
+        elif embed_backend == 'local':
+            self.embed_model = LazyEmbedding(functools.partial(local_embedding, local_embed_model, embed_batch_size),
+                                             local_embed_model, embed_batch_size=embed_batch_size)
+        else:
+            self.embed_model = LazyEmbedding(functools.partial(gemini_embedding, embed_batch_size),
+                                             GEMINI_EMBED_MODEL, embed_batch_size=embed_batch_size)
+        if embed_cache:
+            self.embed_model = CachedEmbedding(self.embed_model, os.path.join(persist_dir, EMBED_CACHE_FILE))
+        # The FAISS dimension follows the model. It is stored with the index, so only a new index or
+        # a new model asks the model for it.
+        if stored is not None and stored.get('embed_model') == self.embed_model.model_name and 'dim' in stored:
+            self.embed_dim = stored['dim']
+        else:
+            self.embed_dim = len(self.embed_model.get_text_embedding('dimension probe'))
+        self.reader = JSONReader()
+        self.splitter = CachedTokenTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap, separator="},",)
+        self.splitter.open_cache(os.path.join(persist_dir, NODE_CACHE_FILE))
+        self.persist_dir = persist_dir
+        self.ingest_batch_size = ingest_batch_size
+        # Over-fetch retrieve_top_k candidates, then send only the best rerank_top_n that fit in
+        # token_budget to the LLM. reranker is 'lexical' or a sentence-transformers cross-encoder name.
+        self.retrieve_top_k = retrieve_top_k
+        self.rerank_top_n = rerank_top_n
+        self.token_budget = token_budget
+        self.reranker = reranker
+        self.index_config = dict(DEFAULT_INDEX_CONFIG, **(index_config or {}))
+        # 'faiss' or 'simple', see VECTOR_BACKENDS; index_config only applies to FAISS
+        self.backend = VECTOR_BACKENDS[vector_backend](self.index_config)
+        self.index = None
+        self.keywords = None
+        self.engines = None
+        self.cache = ResponseCache(max_size=cache_size, ttl=cache_ttl, threshold=cache_threshold)
+        # Bounds in-flight LLM calls for all sessions, see native_async for what runs in the pool
+        self.requests = RequestQueue(max_concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self.llm_loop = None
+        self.embedder = EmbeddingPipeline(self.embed_model, os.path.join(persist_dir, EMBED_CHECKPOINT_FILE),
+                                          batch_size=embed_batch_size, workers=embed_workers, max_retries=embed_max_retries,
+                                          checkpoint=not embed_cache)
+        QA_PROMPT_TMPL = (
+            "Your task is to answer all the questions that users ask based only on the context information provided below.\n"
+            "Please answer the question at length and in detail, with full meaning.\n"
+            "In the answer there is no sentence such as: based on the context provided.\n"
+            "Context information is below.\n"
+            "------------------------------------------\n"
+            "{context_str}\n"
+            "The topics may be included in Title"
+            "------------------------------------------\n"
+            "Given the context information and not prior knowledge, "
+            "answer the query.\n"
+            "Query: {query_str}\n"
+            "Answer: "
+            "If the question is about IELTS Reading, the answer should be in the following format:"
+            "1. Title sample 1"
+            "2. Topic"
+            "3. Type of questions"
+            "4. Origin: Book Title and page details"
+            "5. ID: Book ID"
+            "1. Title sample 2"
+            "2. Topic"
+            "3. Type of questions"
+            "4. Origin: Book Title and page details"
+            "5. ID: Book ID"           
+            "If the question is about IELTS Speaking, print as it is"
+        )
+        self.qa_prompt = PromptTemplate(QA_PROMPT_TMPL)
+        if llm is not None:
+            Settings.llm = llm
+        Settings.embed_model = self.embed_model
+        Settings.node_parser = self.splitter
+        Settings.num_output = 512
+        Settings.context_window = 3900
+        # Warm start: reuse the persisted index, then only embed what changed in data_dir.
+        # With ingest=False a loaded index is used as it is, e.g. one built ahead of time by ingest.py.
+        if rebuild or not self.load_index():
+            if persisted is not None:
+                # Rebuilding here would overwrite the prebuilt index with this process's settings
+                raise RuntimeError(f'Could not load the index in {persist_dir}, rebuild it with ingest.py --rebuild')
+            self.index = None
+        if ingest or self.index is None:
+            self.insert_data(data_dir)
+        self.update_engine()
+
+
+
+
+    def read_data(self, data_dir):
+        # Generator, so documents are parsed only as fast as ingestion consumes them
+        file_list = os.listdir(data_dir)
+        for file_name in file_list:
+            print(file_name)
+            for item in iter_json_items(f'{data_dir}/{file_name}'):
+                text = json.dumps(item)
+                # Keyed by content so an unchanged item keeps its id between runs
+                doc_id = content_hash(f'{DOCUMENT_VERSION}:' + json.dumps(item, sort_keys=True))
+                # The fields are already in the text, keep them out of the embedding and the prompt
+                metadata = extract_metadata(item)
+                yield Document(text=text, doc_id=doc_id, metadata=metadata,
+                               excluded_embed_metadata_keys=list(metadata), excluded_llm_metadata_keys=list(metadata))
+
+    def exact_embeddings(self, node_ids):
+        # The embeddings of stored nodes, for retraining a quantized index. With the embedding
+        # cache on these are cache hits; without it the texts are embedded again.
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in self.index.docstore.get_nodes(node_ids)]
+        return [embedding for batch in batched(texts, self.embedder.batch_size) for embedding in self.embedder.embed_batch(batch)]
+
+    def has_persisted(self):
+        return all(os.path.exists(os.path.join(self.persist_dir, f)) for f in PERSIST_FILES + [INDEX_CONFIG_FILE])
+
+    def load_index(self):
+        if not self.has_persisted():
+            return False
+        persisted = read_index_config(self.persist_dir)
+        target = persisted.get('target', persisted['key'])
+        if target != self.backend.key() or persisted.get('embed_model') != self.embed_model.model_name:
+            print('Index type or embedding model changed, rebuilding')
+            return False
+        try:
+            vector_store = self.backend.load(self.persist_dir)
+            storage_context = StorageContext.from_defaults(vector_store=vector_store, persist_dir=self.persist_dir)
+            index = load_index_from_storage(storage_context)
+        except Exception as e:
+            print('Could not load persisted index:', e)
+            return False
+        # The vector store and the docstore are written separately, make sure they still agree
+        count, dim = self.backend.shape(vector_store)
+        if (count and dim != self.embed_dim) or count != len(index.index_struct.nodes_dict):
+            print('Persisted index is out of date, rebuilding')
+            return False
+        keyword_path = os.path.join(self.persist_dir, KEYWORD_INDEX_FILE)
+        if os.path.exists(keyword_path):
+            self.keywords = KeywordIndex.load(keyword_path)
+        else:
+            self.keywords = KeywordIndex()
+            self.keywords.add(index.docstore.docs.values())
+        self.vector_store = vector_store
+        self.storage_context = storage_context
+        self.index = index
+        print('Loaded index from', self.persist_dir)
+        self.print_footprint()
+        return True
+
+    def index_footprint(self):
+        # Bytes held by the persisted vector store, next to what the same vectors take as plain float32
+        count, dim = self.backend.shape(self.vector_store)
+        path = os.path.join(self.persist_dir, PERSIST_FILES[0])
+        return {
+            # What was built, not what is configured: see build_faiss_index for when they differ
+            'type': self.backend.built_key(self.vector_store),
+            'vectors': count,
+            'dim': dim,
+            'float32_bytes': count * dim * 4,
+            'index_bytes': os.path.getsize(path) if os.path.exists(path) else None,
+            'mmap': self.backend.mapped(self.vector_store),
+        }
+
+    def print_footprint(self):
+        footprint = self.index_footprint()
+        where = 'memory-mapped, shared page cache' if footprint['mmap'] else 'in process memory'
+        size = footprint['index_bytes'] / 2 ** 20 if footprint['index_bytes'] is not None else float('nan')
+        print(f"Index {footprint['type']}: {footprint['vectors']} vectors, {size:.1f} MB ({where}), "
+              f"{footprint['float32_bytes'] / 2 ** 20:.1f} MB as float32")
+
+    def new_index(self, vectors):
+        self.vector_store = self.backend.create(vectors, self.embed_dim)
+        self.storage_context = StorageContext.from_defaults(vector_store=self.vector_store)
+        self.index = VectorStoreIndex([], storage_context=self.storage_context)
+        self.keywords = KeywordIndex()
+
+    def insert_data(self, data_dir):
+        # Documents -> nodes -> embeddings -> index, one batch of ingest_batch_size documents at a time
+        with self.metrics.trace('ingest'):
+            existing = self.index.ref_doc_info if self.index is not None else {}
+            seen = set()
+            added = 0
+            num_nodes = 0
+            pending = []
+            batches = batched(self.read_data(data_dir), self.ingest_batch_size)
+            while True:
+                with stage('read'):
+                    documents = next(batches, None)
+                if documents is None:
+                    break
+                new_documents = [doc for doc in documents if doc.doc_id not in existing and doc.doc_id not in seen]
+                seen.update(doc.doc_id for doc in documents)
+                # Nodes are parsed once here and inserted as-is, the index never re-parses the documents
+                with stage('split'):
+                    nodes = self.splitter.get_nodes_from_documents(new_documents)
+                    self.splitter.commit()
+                with stage('embed'):
+                    self.embedder.run(nodes)
+                added += len(new_documents)
+                num_nodes += len(nodes)
+                with stage('index'):
+                    if self.index is None:
+                        # Trained index types (IVF, PQ) need a sample of embeddings before the index can be created
+                        pending += nodes
+                        if len(pending) < max(1, self.backend.training_size()):
+                            continue
+                        self.new_index(np.array([node.embedding for node in pending], dtype='float32'))
+                        nodes, pending = pending, []
+                    self.index.insert_nodes(nodes)
+                    self.keywords.add(nodes)
+            with stage('index'):
+                if self.index is None:
+                    self.new_index(np.array([node.embedding for node in pending], dtype='float32').reshape(-1, self.embed_dim))
+                    self.index.insert_nodes(pending)
+                    self.keywords.add(pending)
+            # A changed item has a new hash, so it shows up as one removal plus one addition
+            removed = [doc_id for doc_id in existing if doc_id not in seen]
+            with stage('delete'):
+                # Copy the ids first, deleting from the docstore empties the lists in ref_doc_info.
+                # One call for all of them: each call rewrites the index struct, and on every FAISS
+                # type but flat rebuilds the index (see FaissIdMapVectorStore.delete_nodes).
+                removed_nodes = [node_id for doc_id in removed for node_id in existing[doc_id].node_ids]
+                if removed_nodes:
+                    self.index.delete_nodes(removed_nodes, delete_from_docstore=True)
+                self.keywords.remove(removed_nodes)
+            count('documents_added', added)
+            count('documents_removed', len(removed))
+            count('nodes_added', num_nodes)
+            print('Added documents:', added, 'Removed documents:', len(removed))
+            print('Number of nodes:', num_nodes)
+            if added or removed:
+                # Cached answers may cite documents that changed
+                self.cache.clear()
+            retrained = self.backend.needs_retrain(self.vector_store)
+            if retrained:
+                with stage('retrain'):
+                    old_key = self.backend.built_key(self.vector_store)
+                    self.backend.retrain(self.vector_store, self.exact_embeddings)
+                    print(f'Retrained index {old_key} -> {self.backend.built_key(self.vector_store)}')
+            with stage('persist'):
+                if added or removed or retrained or not self.has_persisted():
+                    self.persist()
+                    self.print_footprint()
+                self.embedder.clear_checkpoint()
+
+    def persist(self):
+        self.index.storage_context.persist(persist_dir=self.persist_dir)
+        self.keywords.save(os.path.join(self.persist_dir, KEYWORD_INDEX_FILE))
+        # Written last: its modification time is the version of the whole persisted index
+        with open(os.path.join(self.persist_dir, INDEX_CONFIG_FILE), 'w', encoding='utf-8') as out:
+            # key: the index actually built, target: the configured one it is retrained into
+            json.dump({'key': self.backend.built_key(self.vector_store), 'target': self.backend.key(),
+                       'config': self.index_config, 'embed_model': self.embed_model.model_name,
+                       'dim': self.embed_dim}, out, indent=2)
+
+    def node_postprocessors(self):
+        if self.reranker == 'lexical':
+            rerank = LexicalRerank(self.keywords, top_n=self.rerank_top_n)
+        else:
+            # Needs sentence-transformers, which llama-index-embeddings-huggingface pulls in
+            from llama_index.core.postprocessor import SentenceTransformerRerank
+            rerank = SentenceTransformerRerank(model=self.reranker, top_n=self.rerank_top_n)
+        return [DedupPostprocessor(), rerank, TokenBudgetPostprocessor(token_budget=self.token_budget)]
+
+    def update_engine(self):
+        self.retriever = HybridRetriever(self.index.as_retriever(similarity_top_k=self.retrieve_top_k), self.keywords,
+                                         self.index.docstore, top_k=self.retrieve_top_k)
+        self.postprocessors = self.node_postprocessors()
+        with self.client_lock:
+            # Built on the first question, they need the LLM client
+            self.engines = None
+
+    @property
+    def llm(self):
+        with self.client_lock:
+            if self._llm is None:
+                from llama_index.llms.gemini import Gemini
+                self._llm = Gemini(model_name=GEMINI_LLM_MODEL, api_key=os.environ["GOOGLE_API_KEY"])
+                Settings.llm = self._llm
+            return self._llm
+
+    @property
+    def native_async(self):
+        # CustomLLM backends only have sync calls underneath, so their requests run in the
+        # thread pool instead of on the event loop
+        return not isinstance(self.llm, CustomLLM)
+
+    def on_llm_loop(self, awaitable):
+        # Async LLM clients stay bound to the event loop they were first used on (Gemini's grpc.aio
+        # channel is cached per process), while callers may bring a new loop per request, e.g. one
+        # asyncio.run per Streamlit message. So every async LLM call runs on one long-lived loop
+        # in a daemon thread and the caller's loop only awaits the result.
+        with self.client_lock:
+            if self.llm_loop is None:
+                self.llm_loop = asyncio.new_event_loop()
+                threading.Thread(target=self.llm_loop.run_forever, daemon=True).start()
+        return asyncio.wrap_future(asyncio.run_coroutine_threadsafe(awaited(awaitable), self.llm_loop))
+
+    def get_engines(self):
+        with self.client_lock:
+            if self.engines is None:
+                query_engine = RetrieverQueryEngine.from_args(self.retriever, llm=self.llm, node_postprocessors=self.postprocessors)
+                stream_engine = RetrieverQueryEngine.from_args(self.retriever, llm=self.llm, node_postprocessors=self.postprocessors, streaming=True)
+                for engine in (query_engine, stream_engine):
+                    engine.update_prompts(
+                        {"response_synthesizer:text_qa_template": self.qa_prompt}
+                    )
+                self.engines = (query_engine, stream_engine)
+            return self.engines
+
+    @property
+    def query_engine(self):
+        return self.get_engines()[0]
+
+    @property
+    def stream_engine(self):
+        return self.get_engines()[1]
+
+    def filter_nodes(self, **filters):
+        # Exact metadata lookup without the LLM, e.g. filter_nodes(question_type='Matching Headings')
+        allowed = self.keywords.filter_ids({field: field_values(value) for field, value in filters.items()})
+        return [self.index.docstore.get_node(node_id) for node_id in sorted(allowed or ())]
+
+    def lookup_cache(self, prompt):
+        with stage('response_cache'):
+            response = self.cache.get(prompt)
+        if response is not None:
+            count('response_cache_hits')
+            return response, None
+        # The retriever needs the query embedding anyway, so the semantic lookup costs nothing extra
+        with stage('embed_query'):
+            embedding = self.embed_model.get_query_embedding(prompt)
+        with stage('response_cache'):
+            response = self.cache.get_similar(embedding)
+        count('response_cache_hits' if response is not None else 'response_cache_misses')
+        return response, embedding
+
+    def retrieve_nodes(self, query_bundle):
+        # What the query engines do before synthesis, split up so every step is timed
+        with stage('retrieve'):
+            nodes = self.retriever.retrieve(query_bundle)
+        with stage('rerank'):
+            for postprocessor in self.postprocessors:
+                nodes = postprocessor.postprocess_nodes(nodes, query_bundle=query_bundle)
+        with stage('prompt'):
+            # Approximate prompt size: the QA template filled with the chunks as one context block
+            context = '\n\n'.join(node.node.get_content(metadata_mode=MetadataMode.LLM) for node in nodes)
+            count('prompt_tokens', len(get_tokenizer()(self.qa_prompt.format(context_str=context, query_str=query_bundle.query_str))))
+        return nodes
+
+    def query(self, prompt):
+        with self.metrics.trace('query'):
+            response, embedding = self.lookup_cache(prompt)
+            if response is None:
+                query_bundle = QueryBundle(prompt, embedding=embedding)
+                nodes = self.retrieve_nodes(query_bundle)
+                with stage('generate'):
+                    response = self.query_engine.synthesize(query_bundle, nodes)
+                count('completion_tokens', len(get_tokenizer()(str(response))))
+                self.cache.put(prompt, embedding, response)
+            return response
+
+    def stream_query(self, prompt):
+        # Returns the source nodes and a generator of answer chunks. Retrieval runs before
+        # generation, so the sources are known before the first token arrives.
+        owned = current_trace.get() is None
+        with self.metrics.trace('query', defer=True) as trace:
+            response, embedding = self.lookup_cache(prompt)
+            if response is not None:
+                if owned:
+                    self.metrics.record(trace)
+                return response.source_nodes, iter([str(response)])
+            query_bundle = QueryBundle(prompt, embedding=embedding)
+            nodes = self.retrieve_nodes(query_bundle)
+            start = time.perf_counter()
+            streaming = self.stream_engine.synthesize(query_bundle, nodes)
+
+        def stream():
+            chunks = []
+            try:
+                for chunk in streaming.response_gen:
+                    if not chunks:
+                        trace.add('first_token', time.perf_counter() - start)
+                    chunks.append(chunk)
+                    yield chunk
+                self.cache.put(prompt, embedding, Response(''.join(chunks), source_nodes=streaming.source_nodes, metadata=streaming.metadata))
+            finally:
+                trace.add('generate', time.perf_counter() - start)
+                trace.count('completion_tokens', len(get_tokenizer()(''.join(chunks))))
+                if owned:
+                    self.metrics.record(trace)
+        return streaming.source_nodes, stream()
+
+    async def aquery(self, prompt, user='default', on_wait=None):
+        # Exact cache hits skip the queue. Retrieval is CPU work and runs in the thread pool,
+        # generation awaits the LLM's async client so waiting on Gemini holds no thread.
+        with self.metrics.trace('query'):
+            response = self.cache.get(prompt)
+            if response is not None:
+                count('response_cache_hits')
+                return response
+            loop = asyncio.get_running_loop()
+            with stage('queue_wait'):
+                await self.requests.acquire(user, on_wait)
+            try:
+                if not self.native_async:
+                    return await loop.run_in_executor(self.executor, in_context(self.query, prompt))
+                response, embedding = await loop.run_in_executor(self.executor, in_context(self.lookup_cache, prompt))
+                if response is None:
+                    query_bundle = QueryBundle(prompt, embedding=embedding)
+                    nodes = await loop.run_in_executor(self.executor, in_context(self.retrieve_nodes, query_bundle))
+                    with stage('generate'):
+                        response = await self.on_llm_loop(self.query_engine.asynthesize(query_bundle, nodes))
+                    count('completion_tokens', len(get_tokenizer()(str(response))))
+                    self.cache.put(prompt, embedding, response)
+                return response
+            finally:
+                self.requests.release(user)
+
+    async def astream_query(self, prompt, user='default', on_wait=None):
+        # Async counterpart of stream_query. The queue slot is held, and the trace left open,
+        # until the returned QueueSlotStream is exhausted or closed: callers that may stop
+        # early, or never iterate at all, must aclose() it.
+        with self.metrics.trace('query', defer=True) as trace:
+            response = self.cache.get(prompt)
+            if response is not None:
+                count('response_cache_hits')
+                self.metrics.record(trace)
+                return response.source_nodes, aiter_chunks([str(response)])
+            loop = asyncio.get_running_loop()
+            with stage('queue_wait'):
+                await self.requests.acquire(user, on_wait)
+            try:
+                if not self.native_async:
+                    sources, chunks = await loop.run_in_executor(self.executor, in_context(self.stream_query, prompt))
+                    return sources, QueueSlotStream(aiter_sync(chunks, loop, self.executor), self.finish_stream, user, trace)
+                response, embedding = await loop.run_in_executor(self.executor, in_context(self.lookup_cache, prompt))
+                if response is not None:
+                    self.requests.release(user)
+                    self.metrics.record(trace)
+                    return response.source_nodes, aiter_chunks([str(response)])
+                query_bundle = QueryBundle(prompt, embedding=embedding)
+                nodes = await loop.run_in_executor(self.executor, in_context(self.retrieve_nodes, query_bundle))
+                start = time.perf_counter()
+                streaming = await self.on_llm_loop(self.stream_engine.asynthesize(query_bundle, nodes))
+            except BaseException:
+                self.requests.release(user)
+                raise
+
+        async def stream():
+            chunks = []
+            # The chunks come from the LLM's client, so they are pulled on the LLM loop too
+            response_gen = streaming.async_response_gen()
+            done = object()
+            try:
+                while (chunk := await self.on_llm_loop(anext(response_gen, done))) is not done:
+                    if not chunks:
+                        trace.add('first_token', time.perf_counter() - start)
+                    chunks.append(chunk)
+                    yield chunk
+                self.cache.put(prompt, embedding, Response(''.join(chunks), source_nodes=streaming.source_nodes, metadata=streaming.metadata))
+            finally:
+                await self.on_llm_loop(response_gen.aclose())
+                trace.add('generate', time.perf_counter() - start)
+                trace.count('completion_tokens', len(get_tokenizer()(''.join(chunks))))
+        return streaming.source_nodes, QueueSlotStream(stream(), self.finish_stream, user, trace)
+
+    def finish_stream(self, user, trace):
+        self.requests.release(user)
+        self.metrics.record(trace)
+
+
+class QueueSlotStream:
+    # Async iterator over the answer chunks of a request that holds a RequestQueue slot. The
+    # slot is released once, when the chunks run out, fail, or aclose() is called, whether or
+    # not iteration ever started. A stream that is dropped unclosed releases it when collected.
+    def __init__(self, chunks, finish, *args):
+        self.chunks = chunks
+        self.finish = functools.partial(finish, *args)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.chunks is None:
+            raise StopAsyncIteration
+        try:
+            return await anext(self.chunks)
+        except BaseException:
+            await self.aclose()
+            raise
+
+    async def aclose(self):
+        if self.chunks is None:
+            return
+        chunks, self.chunks = self.chunks, None
+        try:
+            await chunks.aclose()
+        finally:
+            self.finish()
+
+    def __del__(self):
+        if self.chunks is not None:
+            self.chunks = None
+            self.finish()
+
+
+async def awaited(awaitable):
+    # run_coroutine_threadsafe only takes coroutines, not e.g. anext() or aclose()
+    return await awaitable
+
+
+async def aiter_chunks(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+async def aiter_sync(chunks, loop, executor):
+    # Pulls a blocking generator one item at a time on the thread pool
+    done = object()
+    try:
+        while (chunk := await loop.run_in_executor(executor, next, chunks, done)) is not done:
+            yield chunk
+    finally:
+        # Unless a cancelled next() is still running on the pool, the generator then ends on its own
+        if not chunks.gi_running:
+            chunks.close()
+
+
+class DedupPostprocessor(BaseNodePostprocessor):
+    # Drops chunks whose text is the same as a higher ranked one, ignoring case and punctuation
+    def _postprocess_nodes(self, nodes, query_bundle=None):
+        seen = set()
+        kept = []
+        for node in nodes:
+            key = content_hash(' '.join(tokenize(node.node.get_content())))
+            if key not in seen:
+                seen.add(key)
+                kept.append(node)
+        return kept
+
+
+class LexicalRerank(BaseNodePostprocessor):
+    # Cheap local reranker: the share of the query's IDF weight a chunk covers,
+    # ties broken by the retrieval score
+    top_n: int = 4
+    _keywords = PrivateAttr()
+
+    def __init__(self, keywords, top_n=4):
+        super().__init__(top_n=top_n)
+        self._keywords = keywords
+
+    def _postprocess_nodes(self, nodes, query_bundle=None):
+        if query_bundle is None:
+            return nodes[:self.top_n]
+        weights = {token: self._keywords.idf(token) for token in set(tokenize(query_bundle.query_str))}
+        total = sum(weights.values()) or 1.0
+        scored = []
+        for node in nodes:
+            tokens = set(tokenize(node.node.get_content()))
+            scored.append((sum(w for token, w in weights.items() if token in tokens) / total, node.score or 0.0, node))
+        scored.sort(key=itemgetter(0, 1), reverse=True)
+        return [NodeWithScore(node=node.node, score=score) for score, _, node in scored[:self.top_n]]
+
+
+class TokenBudgetPostprocessor(BaseNodePostprocessor):
+    # Keeps the best chunks that fit in token_budget prompt tokens, the first one always stays
+    token_budget: int = 2800
+
+    def _postprocess_nodes(self, nodes, query_bundle=None):
+        tokenizer = get_tokenizer()
+        kept = []
+        used = 0
+        for node in nodes:
+            size = len(tokenizer(node.node.get_content(metadata_mode=MetadataMode.LLM)))
+            if kept and used + size > self.token_budget:
+                continue
+            kept.append(node)
+            used += size
+        return kept
+
+
+def Get_id(source_nodes, reply=''):
+    # Book IDs of the retrieved sources, read from node metadata instead of parsed out of the
+    # reply. Sources the reply mentions come first, otherwise retrieval order is kept.
+    ids = []
+    for node in source_nodes:
+        book_id = node.node.metadata.get('book_id')
+        if book_id and book_id not in ids:
+            ids.append(book_id)
+    return sorted(ids, key=lambda book_id: book_id not in reply)
+
+
+def Get_pages(source_nodes, book_id):
+    # Page range from the "Origin" field of the first source of book_id, e.g. "page 12" or "pages 12-15"
+    for node in source_nodes:
+        if node.node.metadata.get('book_id') == book_id:
+            match = re.search(r'pages?\s*(\d+)(?:\s*[-–]\s*(\d+))?', node.node.metadata.get('origin', ''), re.IGNORECASE)
+            if match:
+                return list(range(int(match.group(1)), int(match.group(2) or match.group(1)) + 1))
+    return []
+
+
+
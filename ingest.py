@@ -0,0 +1,51 @@
+import argparse
+
+from chatbot import (Chatbot, INDEX_TYPES, VECTOR_BACKENDS, GEMINI_EMBED_MODEL, LOCAL_EMBED_MODEL,
+                     read_index_config)
+from stores import PERSIST_DIRS
+
+# Builds or updates the persisted index ahead of time, so the web app only has to load it.
+# Run it after changing data/ (or on a schedule); a running app picks the new index up by itself.
+#
+#   python ingest.py                                   # update storage/ with what changed in data/
+#   python ingest.py --rebuild --index-type ivf_sq8    # full rebuild with another index type
+#   python ingest.py --vector-backend simple           # the index main_no_faiss.py serves
+#
+# The app serves the index with the type and embedding model it was built with here, so
+# there is nothing to keep in sync between the two.
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the chatbot index from the question bank')
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--persist-dir', help='default: where the app looks for --vector-backend, see PERSIST_DIRS')
+    parser.add_argument('--vector-backend', default='faiss', choices=sorted(VECTOR_BACKENDS))
+    parser.add_argument('--rebuild', action='store_true', help='ignore the persisted index and build from scratch')
+    parser.add_argument('--index-type', choices=sorted(INDEX_TYPES), help='default: keep the persisted one, else flat')
+    for key in ('nlist', 'nprobe', 'pq_m', 'pq_nbits', 'hnsw_m', 'ef_construction', 'ef_search'):
+        parser.add_argument('--' + key.replace('_', '-'), type=int)
+    parser.add_argument('--embed-backend', choices=['gemini', 'local'], help='default: keep the persisted one, else gemini')
+    parser.add_argument('--embed-workers', type=int, default=4)
+    parser.add_argument('--ingest-batch-size', type=int, default=256)
+    args = parser.parse_args()
+
+    persist_dir = args.persist_dir or PERSIST_DIRS[args.vector_backend]
+    # Options not given keep what the persisted index was built with, so a plain run only syncs data/
+    persisted = read_index_config(persist_dir) or {}
+    index_config = dict(persisted.get('config', {}))
+    if args.index_type is not None:
+        index_config['type'] = args.index_type
+    for key in ('nlist', 'nprobe', 'pq_m', 'pq_nbits', 'hnsw_m', 'ef_construction', 'ef_search'):
+        if getattr(args, key) is not None:
+            index_config[key] = getattr(args, key)
+    persisted_local = persisted.get('embed_model') not in (None, GEMINI_EMBED_MODEL)
+    embed_backend = args.embed_backend or ('local' if persisted_local else 'gemini')
+    local_embed_model = persisted['embed_model'] if persisted_local else LOCAL_EMBED_MODEL
+    # Loads what is persisted, embeds only the changes and persists the result (printing its size)
+    Chatbot(args.data_dir, persist_dir=persist_dir, rebuild=args.rebuild, index_config=index_config,
+            vector_backend=args.vector_backend, embed_backend=embed_backend, local_embed_model=local_embed_model,
+            embed_workers=args.embed_workers, ingest_batch_size=args.ingest_batch_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+import time
+import os
+import json
+import threading
+import contextvars
+import functools
+from collections import Counter, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+# Tracing and aggregation of per-stage timings. Kept apart from chatbot.py so the web app can
+# record and show metrics before the engine (and llama-index) is imported.
+
+
+# The trace of the request or ingest run on this thread / asyncio task, if any
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+class Trace:
+    # Stage timings and counts (tokens, cache hits and misses, ...) of one query or ingest run
+    def __init__(self, kind):
+        self.kind = kind
+        self.time = time.time()
+        self.start = time.perf_counter()
+        self.seconds = {}
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        # Stages may nest (retrieve contains vector_search and keyword_search) and repeat (they add up)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+    def record(self):
+        with self.lock:
+            return {'kind': self.kind, 'time': self.time, 'total': time.perf_counter() - self.start,
+                    'seconds': dict(self.seconds), 'counts': dict(self.counts)}
+
+
+@contextmanager
+def stage(name):
+    # Times the block into the current trace; a no-op outside one
+    trace = current_trace.get()
+    if trace is None:
+        yield
+    else:
+        with trace.stage(name):
+            yield
+
+
+def count(name, n=1):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.count(name, n)
+
+
+def in_context(fn, *args):
+    # Runs fn on a thread pool inside a copy of the caller's context, so it sees the current trace
+    return functools.partial(contextvars.copy_context().run, fn, *args)
+
+
+class JsonlMetricsSink:
+    # Appends every finished trace to a JSON Lines file
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    def __call__(self, record):
+        with self.lock, open(self.path, 'a', encoding='utf-8') as out:
+            out.write(json.dumps(record) + '\n')
+
+
+class Metrics:
+    # Aggregates finished traces per (kind, stage) for the Prometheus text format and the admin
+    # panel, and hands every trace record to the sinks (any callable, e.g. JsonlMetricsSink)
+    def __init__(self, sinks=(), window=1000):
+        self.sinks = list(sinks)
+        self.window = window
+        self.lock = threading.Lock()
+        self.samples = {}      # (kind, stage) -> the last window durations
+        self.total = Counter()  # (kind, stage) -> seconds
+        self.calls = Counter()  # (kind, stage) -> observations
+        self.counts = Counter()  # (kind, name) -> total
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    @contextmanager
+    def trace(self, kind, defer=False):
+        # Makes a new trace current for the block and records it at the end. Inside another trace
+        # (query run from aquery's thread pool) the outer one is used and its owner records it.
+        # With defer=True the caller records it later, e.g. when a stream finishes.
+        outer = current_trace.get()
+        if outer is not None:
+            yield outer
+            return
+        trace = Trace(kind)
+        token = current_trace.set(trace)
+        try:
+            yield trace
+        except BaseException:
+            trace.count('errors')
+            self.record(trace)
+            raise
+        finally:
+            current_trace.reset(token)
+        if not defer:
+            self.record(trace)
+
+    def observe(self, kind, name, seconds):
+        with self.lock:
+            key = (kind, name)
+            self.samples.setdefault(key, deque(maxlen=self.window)).append(seconds)
+            self.total[key] += seconds
+            self.calls[key] += 1
+
+    def record(self, trace):
+        record = trace.record()
+        for name, seconds in [('total', record['total'])] + list(record['seconds'].items()):
+            self.observe(trace.kind, name, seconds)
+        with self.lock:
+            for name, n in record['counts'].items():
+                self.counts[(trace.kind, name)] += n
+        for sink in self.sinks:
+            try:
+                sink(record)
+            except Exception as e:
+                print('Metrics sink failed:', e)
+
+    def snapshot(self):
+        with self.lock:
+            stages = []
+            for (kind, name), samples in sorted(self.samples.items()):
+                ms = np.asarray(samples) * 1000
+                stages.append({'kind': kind, 'stage': name, 'count': self.calls[(kind, name)],
+                               'mean_ms': float(ms.mean()), 'p50_ms': float(np.percentile(ms, 50)),
+                               'p95_ms': float(np.percentile(ms, 95)), 'p99_ms': float(np.percentile(ms, 99))})
+            counts = [{'kind': kind, 'name': name, 'total': n} for (kind, name), n in sorted(self.counts.items())]
+        return stages, counts
+
+    def prometheus_text(self):
+        stages, counts = self.snapshot()
+        lines = ['# TYPE chatbot_stage_seconds summary']
+        for row in stages:
+            labels = f'kind="{row["kind"]}",stage="{row["stage"]}"'
+            for quantile, key in (('0.5', 'p50_ms'), ('0.95', 'p95_ms'), ('0.99', 'p99_ms')):
+                lines.append(f'chatbot_stage_seconds{{{labels},quantile="{quantile}"}} {row[key] / 1000:.6f}')
+            with self.lock:
+                lines.append(f'chatbot_stage_seconds_sum{{{labels}}} {self.total[(row["kind"], row["stage"])]:.6f}')
+            lines.append(f'chatbot_stage_seconds_count{{{labels}}} {row["count"]}')
+        lines.append('# TYPE chatbot_events_total counter')
+        for row in counts:
+            lines.append(f'chatbot_events_total{{kind="{row["kind"]}",event="{row["name"]}"}} {row["total"]}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port=9464, host='127.0.0.1'):
+        # Prometheus scrape endpoint at http://host:port/metrics on a daemon thread
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
@@ -0,0 +1,136 @@
+import time
+import os
+import threading
+import sqlite3
+from collections import OrderedDict, deque
+
+# What the web app reads from disk before the engine is loaded: PDFs, chat history and the
+# versions of data/ and of the persisted index. Only uses the standard library, so the page
+# renders without waiting for llama-index.
+
+# Written last by Chatbot.persist, so its modification time is the version of the persisted index
+INDEX_CONFIG_FILE = 'index_config.json'
+# Where each vector store backend keeps its index, shared by the app and ingest.py
+PERSIST_DIRS = {'faiss': 'storage', 'simple': 'storage_simple'}
+
+
+class PdfStore:
+    # Maps book IDs to the PDFs in pdf_dir and keeps the most recently shown files in
+    # memory, up to max_bytes, so a popular book is only read from disk once
+    def __init__(self, pdf_dir, max_bytes=64 * 1024 * 1024):
+        self.pdf_dir = pdf_dir
+        self.max_bytes = max_bytes
+        self.cache = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.scan()
+
+    def scan(self):
+        self.paths = {entry.name[:-4]: entry.path for entry in os.scandir(self.pdf_dir) if entry.name.lower().endswith('.pdf')}
+
+    def get(self, book_id):
+        with self.lock:
+            data = self.cache.get(book_id)
+            if data is not None:
+                self.cache.move_to_end(book_id)
+                return data
+        if book_id not in self.paths:
+            # Pick up PDFs added since the last scan
+            self.scan()
+        path = self.paths.get(book_id)
+        if path is None:
+            return None
+        with open(path, 'rb') as pdf_file:
+            data = pdf_file.read()
+        with self.lock:
+            if book_id not in self.cache:
+                self.cache[book_id] = data
+                self.size += len(data)
+            while self.size > self.max_bytes and len(self.cache) > 1:
+                self.size -= len(self.cache.popitem(last=False)[1])
+        return data
+
+
+class ConversationStore:
+    # Chat history in SQLite, written through on every message so nothing is lost on restart.
+    # Memory only holds the newest tail_size messages of the max_cached most recently used
+    # conversations; colder ones are evicted and read back from disk when opened again.
+    def __init__(self, path, max_cached=256, tail_size=50):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.max_cached = max_cached
+        self.tail_size = tail_size
+        self.tails = OrderedDict()  # conversation id -> newest messages, oldest first
+        with self.lock:
+            self.conn.executescript('''
+                CREATE TABLE IF NOT EXISTS conversations (id INTEGER PRIMARY KEY, user TEXT, name TEXT, created REAL);
+                CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, conversation INTEGER, role TEXT, content TEXT, created REAL);
+                CREATE INDEX IF NOT EXISTS conversations_by_user ON conversations (user, id);
+                CREATE INDEX IF NOT EXISTS messages_by_conversation ON messages (conversation, id);
+            ''')
+
+    def conversations(self, user):
+        with self.lock:
+            return self.conn.execute('SELECT id, name FROM conversations WHERE user = ? ORDER BY id', (user,)).fetchall()
+
+    def create(self, user, name):
+        with self.lock:
+            conversation = self.conn.execute('INSERT INTO conversations (user, name, created) VALUES (?, ?, ?)',
+                                             (user, name, time.time())).lastrowid
+            self.conn.commit()
+        return conversation
+
+    def rename(self, conversation, name):
+        with self.lock:
+            self.conn.execute('UPDATE conversations SET name = ? WHERE id = ?', (name, conversation))
+            self.conn.commit()
+
+    def delete(self, conversation):
+        with self.lock:
+            self.conn.execute('DELETE FROM messages WHERE conversation = ?', (conversation,))
+            self.conn.execute('DELETE FROM conversations WHERE id = ?', (conversation,))
+            self.conn.commit()
+            self.tails.pop(conversation, None)
+
+    def append(self, conversation, role, content):
+        with self.lock:
+            self.conn.execute('INSERT INTO messages (conversation, role, content, created) VALUES (?, ?, ?, ?)',
+                              (conversation, role, content, time.time()))
+            self.conn.commit()
+            if conversation in self.tails:
+                self.tails[conversation].append({'role': role, 'content': content})
+                self.tails.move_to_end(conversation)
+
+    def count(self, conversation):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM messages WHERE conversation = ?', (conversation,)).fetchone()[0]
+
+    def read(self, conversation, limit):
+        # Called with the lock held
+        rows = self.conn.execute('SELECT role, content FROM messages WHERE conversation = ? ORDER BY id DESC LIMIT ?',
+                                 (conversation, limit)).fetchall()
+        return [{'role': role, 'content': content} for role, content in reversed(rows)]
+
+    def messages(self, conversation, limit):
+        # The newest limit messages, oldest first. Windows up to tail_size come from memory.
+        with self.lock:
+            if limit > self.tail_size:
+                return self.read(conversation, limit)
+            if conversation not in self.tails:
+                self.tails[conversation] = deque(self.read(conversation, self.tail_size), maxlen=self.tail_size)
+                while len(self.tails) > self.max_cached:
+                    self.tails.popitem(last=False)
+            self.tails.move_to_end(conversation)
+            return list(self.tails[conversation])[-limit:] if limit > 0 else []
+
+
+def data_version(data_dir):
+    # Changes whenever a file in data_dir is added, removed or modified
+    return tuple(sorted((f, os.path.getmtime(f'{data_dir}/{f}'), os.path.getsize(f'{data_dir}/{f}')) for f in os.listdir(data_dir)))
+
+
+def index_version(persist_dir):
+    # Changes whenever an index is persisted to persist_dir (by the app or by ingest.py)
+    path = os.path.join(persist_dir, INDEX_CONFIG_FILE)
+    return os.path.getmtime(path) if os.path.exists(path) else None